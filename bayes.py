@@ -27,10 +27,7 @@ import argparse
 
 # This is a module that provides a bunch of simple methods that make
 # accessing the filesystem simpler.
-from utils import fs, log
-
-# needed for log
-import math
+from utils import fs, log, timing
 
 # Python logging allows us to log formatted log messages at different
 # log levels.
@@ -39,15 +36,46 @@ import logging
 # Pulls in tokenizing and import of corpus
 import words
 
+# Counts the cached, integer encoded corpora
+import vocabulary
+
+# The compiled model file format
+import bayes_model
+
+# The classifier itself
+from naive_bayes import NaiveBayesModel
+
+# Serves classifications from a model kept in memory
+import bayes_server
+
 # Used for stopwords
 import nltk
 
-# Used float min
-import sys
-
 # Used to read in unicode files
 import codecs
 
+# Batch results can be written as JSON lines
+import json
+
+# Used to spread batch classification across processes
+import multiprocessing
+
+# Lazily maps documents to results when classifying in a single process
+import itertools
+
+# Used to measure training throughput
+import time
+
+# Used to check for an existing model when updating
+import os
+
+# Hashed term counts are kept as an array of counts per bucket
+import numpy
+
+
+# With feature hashing, a corpus is counted and hashed this many words at a time
+HASHING_CHUNK_SIZE = 1000000
+
 
 ###############################################################################
 #
@@ -62,93 +90,550 @@ def main():
     # setups up any non-ML/NLP config needed by the script (such as logging)
     args = configure_command_line_arguments()
 
+    # Stems from previous runs
+    if args["normalizationCache"]:
+        words.load_normalization_cache(args["normalizationCache"])
+
     # If we are training the classifier
     if args["train"]:
         train_classifier(args)
 
+    # If we are combining models trained separately
+    if args["merge"] is not None:
+        merge_model_shards(args)
+
+    # If we are shrinking a trained model
+    if args["compact"] is not None:
+        compact_classifier(args)
+
+    # If we are measuring the classifier with cross validation
+    if args["evaluate"]:
+        evaluate_classifier(args)
+
     # If we are classifying
     if args["classify"] is not None:
         class_name, log_probability = classify(args)
         logging.info("Classified into " + class_name + " with probability " + str(log_probability))
 
+    # If we are classifying a whole batch of documents
+    if args["batch"] is not None:
+        classify_batch(args)
+
+    # Keep the stems for the next run
+    if args["normalizationCache"]:
+        words.save_normalization_cache(args["normalizationCache"])
+
+    # If we are running as a long lived classification server
+    if args["serve"]:
+        bayes_server.serve(args)
+
 
 
 ###############################################################################
 #
 # We train the classifier using one or more corpora (though one corpora would
-# be pointless).  Training results in a CSV file that captures the class,
-# term and term frequency of each term in all training corpora.  We exclude
-# stop words and punctuation from all calculations.
+# be pointless).  Training results in a compiled model file that captures the
+# class, term and term frequency of each term in all training corpora (see
+# bayes_model.py for the format).  We exclude stop words and punctuation from
+# all calculations.  The same data can optionally be exported as a CSV file.
+#
+# Directories of documents (a custom corpus, or a labelled corpus with one
+# subdirectory per class) can be far too large to load at once, so they are
+# trained map-reduce style: the files are split into shards of shardSize
+# files, the shards are tokenized and counted in parallel (map) and the
+# partial counts are merged into their class as they come back (reduce).
+# Only one shard per worker is ever held in memory.
 #
 ###############################################################################
 
 def train_classifier(args):
     logging.debug("Training classifier")
 
-    training_corpora = {}
-
     # Use the same corpora that we have used in previous demos
     training_set_names = ["abc", "genesis", "gutenberg", "inaugural", "stateUnion", "webtext", "custom"]
 
-    # Open a CSV file with 3 columns.  First column is the name of the corpus (which in this example is also the
-    # name of the class).  Second is a single term from the corpus. Third is the probability with which the term occurs.
-    training = fs.open_csv_file("bayes_training.csv", ["class", "term", "probability"]);
-
     # Ignore stopwords
     stopwords = nltk.corpus.stopwords.words('english')
 
-    # Iterate through each of the training sets
-    for training_set_name in training_set_names:
+    # Each corpus the user asked for is counted independently of the others.  Directories
+    # of documents are counted in shards.
+    hash_buckets = int(args["hashBuckets"] or 0)
+    training_sets = [(training_set_name, args[training_set_name], args["stemming"], stopwords, args["corpusCache"],
+                      hash_buckets)
+                     for training_set_name in training_set_names if args[training_set_name] and training_set_name != "custom"]
+    training_shards = directory_training_shards(args, stopwords)
+
+    # Count the corpora in parallel when we have more than one worker.  map returns the
+    # results in the order of training_sets, so the classes in the model are always in
+    # the same order no matter which corpus finishes first.  The stems the workers
+    # work out are added to our normalization cache.
+    workers = int(args["workers"])
+    if workers > 1 and len(training_sets) > 1:
+        pool = multiprocessing.Pool(min(workers, len(training_sets)))
+        results = list(words.merge_normalization_cache_updates(
+            pool.map(words.run_with_normalization_cache,
+                     [(count_training_set, training_set) for training_set in training_sets])))
+        pool.close()
+        pool.join()
+    else:
+        results = [count_training_set(training_set) for training_set in training_sets]
+
+    if len(training_shards) > 0:
+        results.extend(count_training_shards(training_shards, workers))
+
+    # The term counts for each class, in the order the classes were trained.  With
+    # feature hashing these are already counts per hash bucket.
+    class_term_counts = [(corpus_name, term_counts)
+                         for corpus_name, term_counts, number_of_tokens, elapsed in results if number_of_tokens > 0]
+
+    # Turn the counts into the compiled model that classify memory maps.  With feature
+    # hashing the model has a fixed number of columns however large the vocabulary is.
+    if hash_buckets:
+        model = bayes_model.compile_hashed_model(class_term_counts, stopwords, args["stemming"], hash_buckets)
+        logging.info("Hashed about " + str(model["hashed_terms"]) + " terms into " + str(hash_buckets)
+                     + " buckets with an estimated collision rate of " + "{0:.4f}".format(model["hash_collision_rate"]))
+    else:
+        model = bayes_model.compile_model(class_term_counts, stopwords, args["stemming"])
+
+    # When updating, the counts from the new documents are added to the existing model
+    # rather than replacing it.  Only the new documents had to be read and counted.
+    if args["update"] and os.path.exists(args["model"]):
+        logging.debug("Updating " + args["model"])
+        model = bayes_model.merge_models([bayes_model.load_model(args["model"]), model])
+
+    # Keep only the most discriminative terms.  Classify then skips every other term.
+    if args["selectFeatures"] is not None:
+        model = bayes_model.select_features(model, args["selectFeatures"], int(args["numFeatures"]))
+        logging.info("Selected " + str(model["vocabulary_size"]) + " terms by " + args["selectFeatures"])
+
+    bayes_model.save_model(args["model"], model)
+
+    # Optionally write the counts out as a CSV with 3 columns.  First column is the name of the corpus (which in
+    # this example is also the name of the class).  Second is a single term from the corpus. Third is the number
+    # of times the term occurs.
+    if args["exportCsv"]:
+        export_training_csv(model, "bayes_training.csv")
+
+    for corpus_name, term_counts, number_of_tokens, elapsed in results:
+        logging.info("Trained " + corpus_name + ": " + str(number_of_tokens) + " tokens in "
+                     + "{0:.2f}".format(elapsed) + "s ("
+                     + "{0:.0f}".format(number_of_tokens / max(elapsed, 1e-9)) + " tokens/sec)")
+
+
+###############################################################################
+#
+# The per-class half of training: load one corpus, stem it if stemming is
+# enabled and count its terms.  This runs in a worker process when training
+# in parallel, so it takes everything it needs as a single tuple.  Along with
+# the counts we return the number of tokens processed and how long it took.
+# With a corpus cache, the stemmed corpus comes straight from the cache (see
+# words.load_cached_text_corpus) once it has been read the first time.
+#
+# With hash_buckets set, the counts are an array of counts per hash bucket
+# instead, and the terms are hashed a chunk at a time as they are counted.
+#
+###############################################################################
+
+def count_training_set(training_set):
+    training_set_name, training_set_value, stemming, stopwords, corpus_cache, hash_buckets = training_set
+    start = time.time()
+
+    if corpus_cache is not None:
+        term_ids, corpus_vocabulary, corpus_name = words.load_cached_text_corpus({training_set_name : training_set_value},
+                                                                                 corpus_cache,
+                                                                                 "stem" if stemming else None)
+        term_counts = vocabulary.term_count_dictionary(vocabulary.count_terms(term_ids, corpus_vocabulary), corpus_vocabulary)
+        term_counts = filter_training_terms(term_counts, stopwords)
+        if hash_buckets:
+            term_counts = bayes_model.add_hashed_term_counts(numpy.zeros(hash_buckets, dtype=numpy.uint64), term_counts)
+        return corpus_name, term_counts, len(term_ids), time.time() - start
+
+    # Load the words and corpus name from the requested corpus.
+    terms_array, corpus_name = words.load_text_corpus({training_set_name : training_set_value})
+
+    # Stem the terms if stemming is enabled
+    if stemming:
+        terms_array = words.stem_words_array(terms_array)
+
+    # Count up the unique terms in the words array, hashing each chunk's terms
+    # into buckets as we go if hashing is enabled
+    if hash_buckets:
+        term_counts = numpy.zeros(hash_buckets, dtype=numpy.uint64)
+        for chunk in words.word_chunks(terms_array, HASHING_CHUNK_SIZE):
+            bayes_model.add_hashed_term_counts(term_counts, filter_training_terms(words.collect_term_counts(chunk), stopwords))
+    else:
+        term_counts = filter_training_terms(words.collect_term_counts(terms_array), stopwords)
+
+    return corpus_name, term_counts, len(terms_array), time.time() - start
+
+
+###############################################################################
+#
+# Split the files of a custom corpus and/or a labelled corpus into shards of
+# at most shardSize files.  A shard only ever holds files of one class.
+# Each shard is (class name, file names, stemming, stopwords, corpus cache,
+# hash buckets).
+#
+###############################################################################
+
+def directory_training_shards(args, stopwords):
+    class_file_names = []
+    if args["custom"]:
+        class_file_names.append(("Custom", sorted(fs.directory_file_names(args["custom"], True, None))))
+
+    if args["labelledCorpus"]:
+        for class_name, file_name in fs.labelled_file_names(args["labelledCorpus"]):
+            if len(class_file_names) == 0 or class_file_names[-1][0] != class_name:
+                class_file_names.append((class_name, []))
+            class_file_names[-1][1].append(file_name)
+
+    shard_size = max(int(args["shardSize"]), 1)
+    training_shards = []
+    for class_name, file_names in class_file_names:
+        for start in range(0, len(file_names), shard_size):
+            training_shards.append((class_name, file_names[start:start + shard_size], args["stemming"], stopwords,
+                                    args["corpusCache"], int(args["hashBuckets"] or 0)))
+
+    return training_shards
+
+
+###############################################################################
+#
+# Count every shard and merge the partial counts of each class as the shards
+# finish, in whatever order that is.  Classes keep the order of the shards
+# so the model is the same however the work was scheduled.  Returns the same
+# (class name, term counts, number of tokens, elapsed) results as
+# count_training_set, one per class.  A class's elapsed time is the time
+# spent counting its shards, added up across workers.
+#
+###############################################################################
+
+def count_training_shards(training_shards, workers):
+    if workers > 1 and len(training_shards) > 1:
+        pool = multiprocessing.Pool(min(workers, len(training_shards)))
+        shard_results = words.merge_normalization_cache_updates(
+            pool.imap_unordered(words.run_with_normalization_cache,
+                                [(count_training_shard, training_shard) for training_shard in training_shards]))
+    else:
+        pool = None
+        shard_results = itertools.imap(count_training_shard, training_shards)
+
+    class_counts = {}
+    class_tokens = {}
+    class_elapsed = {}
+    for class_name, term_counts, number_of_tokens, elapsed in shard_results:
+        if class_name not in class_counts:
+            class_counts[class_name] = term_counts
+        elif isinstance(term_counts, dict):
+            merged_counts = class_counts[class_name]
+            for term, count in term_counts.iteritems():
+                merged_counts[term] = merged_counts.get(term, 0) + count
+        else:
+            # Hashed shards are counted per bucket
+            class_counts[class_name] += term_counts
+        class_tokens[class_name] = class_tokens.get(class_name, 0) + number_of_tokens
+        class_elapsed[class_name] = class_elapsed.get(class_name, 0.0) + elapsed
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    class_names = []
+    for class_name, file_names, stemming, stopwords, corpus_cache, hash_buckets in training_shards:
+        if class_name not in class_names:
+            class_names.append(class_name)
+
+    return [(class_name, class_counts[class_name], class_tokens[class_name], class_elapsed[class_name])
+            for class_name in class_names]
+
 
-        # Load the words and corpus name from the requested corpus.
-        terms_array, corpus_name = words.load_text_corpus({training_set_name : args[training_set_name]})
+###############################################################################
+#
+# The map half of sharded training: tokenize, stem and count every file in
+# one shard.  Returns the class name, the shard's filtered term counts, the
+# number of tokens read and how long it took.  With a corpus cache, each
+# shard's stemmed tokens are cached on their own (see
+# words.load_cached_document_files), so a shard whose files haven't changed
+# isn't read again.  With hashing, each file's terms are hashed into the
+# shard's bucket counts as soon as it is counted.
+#
+###############################################################################
+
+def count_training_shard(training_shard):
+    class_name, file_names, stemming, stopwords, corpus_cache, hash_buckets = training_shard
+    start = time.time()
+
+    if corpus_cache is not None:
+        term_ids, shard_vocabulary = words.load_cached_document_files(file_names, corpus_cache, "stem" if stemming else None)
+        term_counts = vocabulary.term_count_dictionary(vocabulary.count_terms(term_ids, shard_vocabulary), shard_vocabulary)
+        term_counts = filter_training_terms(term_counts, stopwords)
+        if hash_buckets:
+            term_counts = bayes_model.add_hashed_term_counts(numpy.zeros(hash_buckets, dtype=numpy.uint64), term_counts)
+        return class_name, term_counts, len(term_ids), time.time() - start
+
+    if hash_buckets:
+        bucket_counts = numpy.zeros(hash_buckets, dtype=numpy.uint64)
+        number_of_tokens = 0
+        for file_name, terms in words.iterate_document_files(file_names):
+            if stemming:
+                terms = words.stem_words_array(terms)
+
+            number_of_tokens += len(terms)
+            bayes_model.add_hashed_term_counts(bucket_counts, filter_training_terms(words.collect_term_counts(terms), stopwords))
+
+        return class_name, bucket_counts, number_of_tokens, time.time() - start
+
+    term_counts = {}
+    number_of_tokens = 0
+    for file_name, terms in words.iterate_document_files(file_names):
+        if stemming:
+            terms = words.stem_words_array(terms)
+
+        number_of_tokens += len(terms)
+        for term in terms:
+            term_counts[term] = term_counts.get(term, 0) + 1
+
+    return class_name, filter_training_terms(term_counts, stopwords), number_of_tokens, time.time() - start
+
+
+###############################################################################
+#
+# Combine models trained on different machines or partitions of the data into
+# a single model.  When training in the same run, the model just trained is
+# one of the models merged.
+#
+###############################################################################
+
+def merge_model_shards(args):
+    shard_file_names = list(args["merge"])
+
+    # A model we just trained is merged along with the shards rather than replaced by them
+    if args["train"]:
+        shard_file_names.insert(0, args["model"])
+
+    shards = [bayes_model.load_model(shard_file_name) for shard_file_name in shard_file_names]
+    model = bayes_model.merge_models(shards)
+    bayes_model.save_model(args["model"], model)
+
+    logging.info("Merged " + str(len(shards)) + " models into " + args["model"] + " with "
+                 + str(len(model["classes"])) + " classes and " + str(model["vocabulary_size"]) + " terms")
+
+
+###############################################################################
+#
+# Prune and/or quantize the trained model and write the result to a new
+# file.  We report the size of the model before and after and, if a held out
+# set of labelled documents is given, the accuracy of both, so the memory
+# saved can be weighed against the accuracy lost.
+#
+###############################################################################
+
+def compact_classifier(args):
+    model = bayes_model.load_model(args["model"])
+    compacted = bayes_model.compact_model(model,
+                                          min_count=int(args["minCount"]),
+                                          top_terms=int(args["topTerms"]),
+                                          count_dtype=args["countType"],
+                                          log_probability_dtype=args["probabilityType"])
+    bayes_model.save_model(args["compact"], compacted)
+
+    report = {"model_bytes_before": os.path.getsize(args["model"]),
+              "model_bytes_after": os.path.getsize(args["compact"]),
+              "terms_before": model["counts"].shape[1],
+              "terms_after": compacted["counts"].shape[1]}
+
+    if args["heldOut"] is not None:
+        documents = fs.labelled_file_names(args["heldOut"])
+        report["held_out_documents"] = len(documents)
+        report["accuracy_before"] = held_out_accuracy(model, documents, args["stemming"] or None)
+        report["accuracy_after"] = held_out_accuracy(bayes_model.load_model(args["compact"]), documents, args["stemming"] or None)
 
-        # Stem the terms if stemming is enabled
-        if args["stemming"]:
-            terms_array = words.stem_words_array(terms_array)
+    log.log_json(report)
 
-        # Count up the unique terms in the words array
-        term_counts = words.collect_term_counts(terms_array)
 
-        # Get the total number of words in entire corpus
-        num_words = float(len(terms_array))
+###############################################################################
+#
+# The fraction of labelled (class name, file name) documents the model puts
+# in the right class.
+#
+###############################################################################
+
+def held_out_accuracy(model, documents, stemming):
+    classifier = NaiveBayesModel(model, stemming)
+    correct = 0
+    for class_name, file_name in documents:
+        predicted_class, log_probability = classifier.score_terms(read_document_terms(file_name, classifier.stemming))
+        if predicted_class == class_name:
+            correct += 1
 
-        # Write the frequency of each term occurring in the given class out to the CSV
-        for term, count in term_counts.iteritems():
-            # We ignore stop words and punctuation
-            if term not in stopwords and term.isalnum():
-                training.writerow([corpus_name, term.lower(), count])
+    return float(correct) / max(len(documents), 1)
 
 
 ###############################################################################
 #
-# Pull in the training data from the csv file.
+# Measure the accuracy and speed of the classifier with k-fold cross
+# validation.  The documents (fileids, or files for a custom corpus) of each
+# selected corpus are sorted and dealt out round robin into k folds: the
+# document at index i goes to fold i % k.  Every class is spread evenly
+# across the folds and the split is the same on every run.  Each fold is
+# then held out in turn: we train on the other folds and classify the
+# documents in the held out fold.  Folds are independent and run in parallel
+# with more than one worker.  We report accuracy and training/classification
+# throughput for each fold and the overall accuracy and confusion matrix.
 #
 ###############################################################################
 
-def load_training_data():
-    training_data = {}
-    class_names = {}
+def evaluate_classifier(args):
+    training_set_names = ["abc", "genesis", "gutenberg", "inaugural", "stateUnion", "webtext", "custom"]
+    number_of_folds = int(args["folds"])
+    stopwords = nltk.corpus.stopwords.words('english')
+
+    # Every document is (class name, training set name, training set value, document id, fold)
+    documents = []
+    class_names = []
+    for training_set_name in training_set_names:
+        if args[training_set_name]:
+            corpus_args = {training_set_name : args[training_set_name]}
+            document_ids, corpus_name = words.text_corpus_document_ids(corpus_args)
+            class_names.append(corpus_name)
+            for index, document_id in enumerate(sorted(document_ids)):
+                documents.append((corpus_name, training_set_name, args[training_set_name], document_id, index % number_of_folds))
+
+    folds = [(fold, documents, args["stemming"], stopwords) for fold in range(number_of_folds)]
+
+    workers = int(args["workers"])
+    if workers > 1:
+        pool = multiprocessing.Pool(min(workers, number_of_folds))
+        results = list(words.merge_normalization_cache_updates(
+            pool.map(words.run_with_normalization_cache, [(evaluate_fold, fold) for fold in folds])))
+        pool.close()
+        pool.join()
+    else:
+        results = [evaluate_fold(fold) for fold in folds]
+
+    confusion_matrix = dict((actual, dict((predicted, 0) for predicted in class_names)) for actual in class_names)
+    correct = 0
+    total = 0
+    for result in results:
+        for actual_class, predicted_class in result["predictions"]:
+            confusion_matrix[actual_class][predicted_class] += 1
+            if actual_class == predicted_class:
+                correct += 1
+            total += 1
+
+        del result["predictions"]
+        log.log_json(result)
+
+    log.log_json({"folds": number_of_folds,
+                  "documents": total,
+                  "accuracy": float(correct) / max(total, 1),
+                  "confusion_matrix": confusion_matrix})
+
 
-    # Read in the CSV file generated during training - comprised of the corpus (class in this example) name, the
-    # term (stemmed or not depending on user input) and the probability of the term occurring within the given class.
-    rows = fs.read_csv("bayes_training.csv")
+###############################################################################
+#
+# Train on every fold but one and classify the documents of that fold.  This
+# runs in a worker process when folds run in parallel.
+#
+###############################################################################
 
-    # Iterate through each of the rows in the CSV file
-    for index, [category_name, term, probability] in enumerate(rows):
+def evaluate_fold(fold_job):
+    fold, documents, stemming, stopwords = fold_job
+
+    # Training: count the terms of every document outside the fold, by class
+    start = time.time()
+    class_names = []
+    class_counts = {}
+    training_tokens = 0
+    for class_name, training_set_name, training_set_value, document_id, document_fold in documents:
+        if document_fold == fold:
+            continue
+
+        terms = load_training_document(training_set_name, training_set_value, document_id, stemming)
+        training_tokens += len(terms)
+
+        if class_name not in class_counts:
+            class_names.append(class_name)
+            class_counts[class_name] = {}
+        for term, count in filter_training_terms(words.collect_term_counts(terms), stopwords).iteritems():
+            class_counts[class_name][term] = class_counts[class_name].get(term, 0) + count
+
+    model = NaiveBayesModel(bayes_model.compile_model([(class_name, class_counts[class_name]) for class_name in class_names],
+                                                      stopwords, stemming),
+                            stemming=False)
+    training_seconds = time.time() - start
+
+    # Classification: classify every document in the fold
+    start = time.time()
+    predictions = []
+    classified_tokens = 0
+    for class_name, training_set_name, training_set_value, document_id, document_fold in documents:
+        if document_fold != fold:
+            continue
+
+        terms = load_training_document(training_set_name, training_set_value, document_id, stemming)
+        classified_tokens += len(terms)
+
+        predicted_class, log_probability = model.score_terms(terms)
+        predictions.append((class_name, predicted_class))
+    classification_seconds = time.time() - start
+
+    correct = len([1 for actual_class, predicted_class in predictions if actual_class == predicted_class])
+
+    return {"fold": fold,
+            "predictions": predictions,
+            "accuracy": float(correct) / max(len(predictions), 1),
+            "training_tokens": training_tokens,
+            "training_seconds": training_seconds,
+            "training_tokens_per_second": training_tokens / max(training_seconds, 1e-9),
+            "classified_documents": len(predictions),
+            "classification_seconds": classification_seconds,
+            "classification_documents_per_second": len(predictions) / max(classification_seconds, 1e-9),
+            "classification_tokens_per_second": classified_tokens / max(classification_seconds, 1e-9)}
+
+
+def load_training_document(training_set_name, training_set_value, document_id, stemming):
+    terms = words.load_text_corpus_document({training_set_name : training_set_value}, document_id)
+    if stemming:
+        terms = words.stem_words_array(terms)
+    return terms
 
-        # Skip the header
-        if index > 0:
 
-            # Store the probabilities for each term
-            if category_name in training_data:
-                training_data[category_name][term] = probability;
-            else:
-                training_data[category_name] = {}
+###############################################################################
+#
+# Lowercase the counted terms and drop stop words and punctuation.  This is
+# the same treatment each term gets when we classify a document, so terms
+# that only differ by case are added together.
+#
+###############################################################################
+
+def filter_training_terms(term_counts, stopwords):
+    stopwords = set(stopwords)
+    filtered_counts = {}
+    for term, count in term_counts.iteritems():
+        term = term.lower()
 
-            class_names[category_name] = category_name
+        # We ignore stop words and punctuation
+        if term not in stopwords and term.isalnum():
+            filtered_counts[term] = filtered_counts.get(term, 0) + count
 
-    return training_data, [name for name in class_names.keys()]
+    return filtered_counts
+
+
+###############################################################################
+#
+# Write every non-zero class/term count in the compiled model to a CSV file.
+#
+###############################################################################
+
+def export_training_csv(model, file_name):
+    training = fs.open_csv_file(file_name, ["class", "term", "probability"])
+
+    for class_index, class_name in enumerate(model["classes"]):
+        for term_index in model["counts"][class_index].nonzero()[0]:
+            training.writerow([class_name,
+                               bayes_model.term_for_id(model, term_index),
+                               int(model["counts"][class_index, term_index])])
 
 
 ###############################################################################
@@ -168,140 +653,210 @@ def classify(args):
     file_name = args["classify"]
     logging.debug("Classify " + file_name)
 
-    # Load the training data and class names.
-    training_data, class_names = load_training_data()
+    # When enabled, we time each stage of classification
+    timings = {} if args["timings"] else None
+
+    # Memory map the compiled model produced by training.  The model carries
+    # the stopwords it was trained with, and whether it was stemmed unless
+    # --stemming says otherwise.
+    with timing.timed_stage(timings, "model_load"):
+        model = NaiveBayesModel.load(args["model"], args["stemming"] or None)
+
+    # Read, tokenize and (optionally) stem the document to classify
+    to_classify_terms = read_document_terms(file_name, model.stemming, timings)
+
+    logging.debug("Total vocabulary size " + str(model.vocabulary_size) + " terms")
+
+    # For long documents we can stop scoring once the leading class can't be overtaken
+    if args["earlyExit"]:
+        with timing.timed_stage(timings, "score"):
+            class_name, log_probability, terms_scored, number_of_terms = model.score_early_exit_terms(to_classify_terms, int(args["chunkSize"]))
+        logging.info("Scored " + str(terms_scored) + " of " + str(number_of_terms) + " terms for every class")
+        log_stage_timings(timings)
+        return class_name, log_probability
+
+    # Explaining scores the document as well, along with the terms behind each class
+    if args["explain"]:
+        with timing.timed_stage(timings, "score"):
+            explanation = model.explain_terms(to_classify_terms, int(args["explainTerms"]))
+        log.log_json(explanation)
+        log_stage_timings(timings)
+        return explanation["class"], explanation["log_probability"]
+
+    # Score every class at once.  This gives us log(P(c)) + log(P(w|c)) for each class c.
+    with timing.timed_stage(timings, "score"):
+        class_probabilities = model.class_log_probabilities(to_classify_terms)
+
+    for class_name, probability in zip(model.classes, class_probabilities):
+        logging.debug("Probability of " + class_name + " is " + str(probability))
+
+    log_stage_timings(timings)
+
+    class_index = int(class_probabilities.argmax())
+    return model.classes[class_index], float(class_probabilities[class_index])
+
 
-    # Read in the document to classify
-    to_classify = codecs.open(args["classify"], "r", "utf-8").read()
+###############################################################################
+#
+# Read in a document, tokenize it and stem the tokens if stemming is enabled.
+#
+###############################################################################
+
+def read_document_terms(file_name, stemming, timings=None):
+    with timing.timed_stage(timings, "file_read"):
+        with codecs.open(file_name, "r", "utf-8") as document:
+            to_classify = document.read()
 
     # Tokenize the document to classify.
-    to_classify_terms = nltk.word_tokenize(to_classify)
+    with timing.timed_stage(timings, "tokenize"):
+        to_classify_terms = nltk.word_tokenize(to_classify)
 
     # If we have enabled stemming then stem these words
-    if args["stemming"]:
-        to_classify_terms = words.stem_words_array(to_classify_terms)
-
-    # We are now ready to actually classify the document.  We need to determine the
-    # the probability that our document (D) is a member of each of our classes (C).
-    # We calculate this probability by taking the product of the probability that
-    # each word in the document belongs to the class C (this is the Naive aspect of
-    # the classifier - we make the assumption that each word probability is independent
-    # of all other word probabilities).  This calculates the probability of the
-    # words in this document given a class C -> P(w|c)
-    class_probabilities = {}
-
-    # In this example, each class is comprised of just one document.  The probability
-    # that a document falls in a class is therefore 1 / the number of classes.  We
-    # use the log probability to counteract the effect of the product of many near-0
-    # probabilities.  In our example we are actually calling each corpus a single document,
-    # so the probability of a given document is 1 / the number of corpora.  If this weren't
-    # the case we'd track the number of documents per category.  Categories with lots of
-    # documents would have higher probabilities of being picked by the classifier because
-    # this term would be relatively high when compared to other categories.
-    log_probability_of_class = math.log(1.0 / len(class_names))
+    if stemming:
+        with timing.timed_stage(timings, "stem"):
+            to_classify_terms = words.stem_words_array(to_classify_terms)
+
+    return to_classify_terms
 
-    stopwords = nltk.corpus.stopwords.words('english')
 
-    # We need the total vocabulary size in order to do laplace smoothing
-    vocabulary_size = calculate_vocabulary_size(training_data);
+###############################################################################
+#
+# Write out the count, mean, median and 99th percentile of each timed stage
+# as JSON lines.  Does nothing if timing isn't enabled.
+#
+###############################################################################
 
-    logging.debug("Total vocabulary size " + str(vocabulary_size) + " terms")
+def log_stage_timings(timings):
+    if timings is None:
+        return
 
-    # Calculate the word probability product for each class P(w|c)
-    for class_name in class_names:
+    for summary in timing.summarize_stage_timings(timings):
+        log.log_json(summary)
 
-        logging.debug("Calculating log probability for class " + class_name)
 
-        # keeping everything log probabilities - math.log(1) = 0
-        log_probability_of_words_in_class = math.log(1)
+###############################################################################
+#
+# Classify many documents with a single model load.  The documents can be a
+# directory, a glob pattern or a file listing one document per line.  Each
+# document is read, tokenized, stemmed and scored in turn and its result is
+# written out as soon as it is ready, so memory use doesn't grow with the
+# number of documents.  With more than one worker the documents are spread
+# across a process pool and results are still written in input order.  The
+# parent maps the model once before the pool starts, so every worker views
+# the same physical copy rather than holding its own: the file's page cache,
+# or shared memory for a model that has to be completed as it is loaded (see
+# bayes_model.share_model_file).  The parent closes the mapping once the pool
+# is done.
+#
+###############################################################################
+
+def classify_batch(args):
+    file_names = fs.expand_file_names(args["batch"], True)
+    logging.debug("Classifying " + str(len(file_names)) + " documents")
 
-        # We need the number of terms in the class (note - NOT unique terms)
-        number_of_terms_in_class = calculate_number_of_terms_in_class(training_data[class_name])
+    results_file, write_result = open_results_file(args["output"])
 
-        logging.debug("Class contains " + str(number_of_terms_in_class) + " terms")
+    # Stage timings come back from the workers along with each result
+    timings = {} if args["timings"] else None
 
-        # Take the product of all the probabilities of a term appearing in the class as
-        # calculated during training
-        for term in to_classify_terms:
+    workers = int(args["workers"])
+    if workers > 1:
+        with timing.timed_stage(timings, "model_load"):
+            model_buffer = NaiveBayesModel.share_file(args["model"])
+        pool = multiprocessing.Pool(workers,
+                                    initializer=start_batch_worker,
+                                    initargs=(model_buffer, args["stemming"] or None, args["timings"]))
+        results = words.merge_normalization_cache_updates(
+            pool.imap(words.run_with_normalization_cache,
+                      ((classify_batch_document, file_name) for file_name in file_names),
+                      chunksize=64))
+    else:
+        pool = None
+        model_buffer = None
+        start_batch_worker(args["model"], args["stemming"] or None, args["timings"])
+        results = itertools.imap(classify_batch_document, file_names)
 
-            # Treat capitalized and lowercase as a single term
-            term = term.lower()
+    number_classified = 0
+    for file_name, class_name, log_probability, document_timings in results:
+        if class_name is not None:
+            write_result(file_name, class_name, log_probability)
+            number_classified += 1
 
-            # We ignore stop words and punctuation
-            if term not in stopwords and term.isalnum():
+        if timings is not None:
+            timing.merge_stage_timings(timings, document_timings)
 
-                # We have to smooth the probabilities of unknown words.  This means that a term we
-                # don't recognize is treated as having a very small probability.  If we left it as 1 it
-                # doesn't impact the product. In truth, unrecognized terms should be treated as rare rather
-                # than common. Here we use laplace smoothing (or add one smoothing)
-                if term in training_data[class_name]:
-                    term_frequency = float(training_data[class_name][term])
-                else:
-                    term_frequency = 0.0
+    if pool is not None:
+        pool.close()
+        pool.join()
+        model_buffer.close()
 
-                # A probability very near 0
-                term_probability_in_trained_class = (term_frequency + 1) / (number_of_terms_in_class + vocabulary_size)
+    results_file.close()
 
-                if args["printProbabilities"]:
-                    logging.warn("The word <" + term + "> occurs with frequency " + str(term_frequency) + " and probability " + str(term_probability_in_trained_class))
+    logging.info("Classified " + str(number_classified) + " documents into " + args["output"])
 
-                # Log probability used in the product to avoid approaching 0 as we multiple small numbers
-                log_probability_of_words_in_class += math.log(term_probability_in_trained_class)
+    log_stage_timings(timings)
 
-        # We now know P(c) and P(w|c).  We are planning to use Bayes Theorem:
-        # P(A|B) = P(B|A) * P(A) / P(B) to learn P(c|w) - the probability of
-        # a class given the words in a document.  Plugging into Bayes Theorem:
-        # P(c|w) = P(w|c) * P(c) / P(w).  P(w) is only a function of the words
-        # in the document we are classifying, and it therefore can be considered
-        # constant across classes.  We can therefore drop it.  So now we have
-        # P(c|w) = P(w|c) * P(c).
-        class_probabilities[class_name] = log_probability_of_words_in_class + log_probability_of_class;
 
-    logging.debug("")
+# The model and stemming option used by classify_batch_document, set up by
+# start_batch_worker from either the model file or the shared memory buffer
+# of a model.  Stemming follows the model unless it is forced on.  If timing
+# is enabled, stage timings collect here until they are sent back with the
+# next result.
+batch_worker = {}
 
-    # We now have a bunch of probabilities, one per class.  We simply take the class associated
-    # with the highest probability and label the document as belonging to that class.
-    max_class = None
-    max_probability = -sys.float_info.max
-    for class_name, probability in class_probabilities.iteritems():
-        logging.debug("Probability of " + class_name + " is " + str(probability))
-        if probability > max_probability:
-            max_probability = probability
-            max_class = class_name
 
-    return max_class, max_probability
+def start_batch_worker(model_source, stemming, timed):
+    batch_worker["timings"] = {} if timed else None
 
-###############################################################################
-#
-# We need to know the entire vocabulary size for the entire corpus domain.  As
-# usual, vocabulary size counts the number of unique terms in a corpus.
-#
-###############################################################################
+    with timing.timed_stage(batch_worker["timings"], "model_load"):
+        if isinstance(model_source, basestring):
+            batch_worker["model"] = NaiveBayesModel.load(model_source, stemming)
+        else:
+            batch_worker["model"] = NaiveBayesModel.from_buffer(model_source, stemming)
 
-def calculate_vocabulary_size(training_data):
-    vocabulary = {}
-    for class_name, class_terms in training_data.iteritems():
-        for term in class_terms:
-            vocabulary[term] = term
+    batch_worker["stemming"] = batch_worker["model"].stemming
 
-    return len(vocabulary)
+
+def classify_batch_document(file_name):
+    timings = batch_worker["timings"]
+    if timings is not None:
+        batch_worker["timings"] = {}
+
+    try:
+        terms = read_document_terms(file_name, batch_worker["stemming"], timings)
+    except (IOError, UnicodeDecodeError) as error:
+        logging.warn("Skipping " + file_name + ": " + str(error))
+        return file_name, None, None, timings
+
+    with timing.timed_stage(timings, "score"):
+        class_name, log_probability = batch_worker["model"].score_terms(terms)
+
+    return file_name, class_name, log_probability, timings
 
 
 ###############################################################################
 #
-# We need to know the number of terms in a class.  We are specifically NOT
-# counting UNIQUE terms.  This is essentially rebuilding the number of words
-# in a document from term frequencies.
+# Batch results are written as CSV, or as JSON lines if the output file name
+# ends in .jsonl.  Returns the open file and a method that writes one result.
 #
 ###############################################################################
 
-def calculate_number_of_terms_in_class(terms):
-    count = 0
-    for term, frequency in terms.iteritems():
-        count += float(frequency)
+def open_results_file(file_name):
+    if file_name.endswith(".jsonl"):
+        results_file = open(file_name, "w")
 
-    return count
+        def write_result(document, class_name, log_probability):
+            results_file.write(json.dumps({"file": document,
+                                           "class": class_name,
+                                           "log_probability": log_probability}) + "\n")
+    else:
+        results_file = open(file_name, "wb")
+        results = fs.csv_writer(results_file, ["file", "class", "log_probability"])
 
+        def write_result(document, class_name, log_probability):
+            results.writerow([document, class_name, log_probability])
+
+    return results_file, write_result
 
 ###############################################################################
 #
@@ -385,27 +940,248 @@ def configure_command_line_arguments():
                         required=False,
                         action='store_true')
 
+    # Hash terms into a fixed number of buckets instead of keeping every term
+    parser.add_argument('-hb',
+                        '--hashBuckets',
+                        help="Number of hash buckets to use for terms, e.g. 1048576 (0 keeps every term).",
+                        required=False,
+                        type=int,
+                        default=0)
+
+    # Write a pruned and/or quantized copy of the model to the given file
+    parser.add_argument('-cp',
+                        '--compact',
+                        help="Write a compacted copy of the model to this file.",
+                        required=False)
+
+    # Drop terms that occur fewer than this many times across all classes
+    parser.add_argument('--minCount',
+                        help="Drop terms occurring fewer times than this when compacting.",
+                        required=False,
+                        type=int,
+                        default=0)
+
+    # Only keep this many terms, ranked by information gain
+    parser.add_argument('--topTerms',
+                        help="Keep only this many terms, by information gain, when compacting.",
+                        required=False,
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--countType',
+                        help="Type used to store counts when compacting.",
+                        required=False,
+                        choices=["uint32", "uint16"],
+                        default="uint32")
+
+    parser.add_argument('--probabilityType',
+                        help="Type used to store log probabilities when compacting.",
+                        required=False,
+                        choices=["float64", "float32", "float16"],
+                        default="float64")
+
+    # A directory of labelled documents (one subdirectory per class) to measure accuracy on
+    parser.add_argument('--heldOut',
+                        help="Directory with one subdirectory of documents per class.",
+                        required=False)
+
+    # Keep tokenized (and stemmed) corpora in a directory for later runs
+    parser.add_argument('-cc',
+                        '--corpusCache',
+                        help="Directory that stores tokenized corpora between runs.",
+                        required=False)
+
+    # Keep stems in a file so later runs don't recompute them
+    parser.add_argument('-nc',
+                        '--normalizationCache',
+                        help="File that stores stems between runs.",
+                        required=False)
+
+    # A directory with one subdirectory of documents per class
+    parser.add_argument('-lc',
+                        '--labelledCorpus',
+                        help="Train on a directory with one subdirectory of documents per class.",
+                        required=False)
+
+    # Directories of documents are trained this many files at a time
+    parser.add_argument('--shardSize',
+                        help="Number of files counted together when training on a directory.",
+                        required=False,
+                        type=int,
+                        default=256)
+
+    # Measure accuracy and speed with k-fold cross validation over the selected corpora
+    parser.add_argument('-e',
+                        '--evaluate',
+                        help="Cross validate the classifier on the selected corpora.",
+                        required=False,
+                        action='store_true')
+
+    parser.add_argument('-k',
+                        '--folds',
+                        help="Number of cross validation folds.",
+                        required=False,
+                        type=int,
+                        default=5)
+
+    # Rank terms by chi-square or mutual information and only keep the best
+    parser.add_argument('-fs',
+                        '--selectFeatures',
+                        help="Select terms by chi-square or mutual information when training.",
+                        required=False,
+                        choices=["chi2", "mi"])
+
+    parser.add_argument('--numFeatures',
+                        help="Number of terms kept by feature selection.",
+                        required=False,
+                        type=int,
+                        default=10000)
+
+    # Add the counts from the selected corpora to the existing model instead of replacing it
+    parser.add_argument('-u',
+                        '--update',
+                        help="Add the training data to the existing model.",
+                        required=False,
+                        action='store_true')
+
+    # Merge models trained separately into the model file
+    parser.add_argument('-mg',
+                        '--merge',
+                        help="Model files to merge into the model file.",
+                        required=False,
+                        nargs='+')
+
     parser.add_argument('-cl',
                         '--classify',
                         help="Classify the contents of classify.txt",
                         required=False)
 
+    # Classify every document in a directory, glob pattern or list of files
+    parser.add_argument('-b',
+                        '--batch',
+                        help="Directory, glob pattern or file listing documents to classify.",
+                        required=False)
+
+    # Where batch results are written.  Use a .jsonl extension for JSON lines.
+    parser.add_argument('-o',
+                        '--output',
+                        help="File batch results are written to (.csv or .jsonl).",
+                        required=False,
+                        default="bayes_classifications.csv")
+
+    # Number of processes used for training and batch classification
+    parser.add_argument('-w',
+                        '--workers',
+                        help="Number of worker processes.",
+                        required=False,
+                        type=int,
+                        default=1)
+
+    # Run a classification server that keeps the model loaded between requests
+    parser.add_argument('-sv',
+                        '--serve',
+                        help="Serve classifications over HTTP.",
+                        required=False,
+                        action='store_true')
+
+    parser.add_argument('--host',
+                        help="Address the server listens on.",
+                        required=False,
+                        default="127.0.0.1")
+
+    parser.add_argument('--port',
+                        help="Port the server listens on.",
+                        required=False,
+                        type=int,
+                        default=8765)
+
+    # Listen on a unix socket instead of a TCP port
+    parser.add_argument('--socket',
+                        help="Unix socket the server listens on.",
+                        required=False)
+
+    # How often the server checks whether the model file has changed
+    parser.add_argument('--reloadInterval',
+                        help="Seconds between checks for a new model file.",
+                        required=False,
+                        type=float,
+                        default=1.0)
+
+    # Score single documents from concurrent server requests together
+    parser.add_argument('--batchSize',
+                        help="Largest number of documents the server scores together.",
+                        required=False,
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--batchWait',
+                        help="Milliseconds the server waits to fill a batch.",
+                        required=False,
+                        type=float,
+                        default=5.0)
+
+    # Stop scoring a document once the leading class can no longer be overtaken
+    parser.add_argument('-ee',
+                        '--earlyExit',
+                        help="Stop scoring once the winning class is certain.",
+                        required=False,
+                        action='store_true')
+
+    # How many terms are scored between checks when exiting early
+    parser.add_argument('--chunkSize',
+                        help="Terms scored between early exit checks.",
+                        required=False,
+                        type=int,
+                        default=256)
+
+    # Time each stage of classification and log a summary as JSON lines
+    parser.add_argument('-ti',
+                        '--timings',
+                        help="Log per-stage classification timings as JSON.",
+                        required=False,
+                        action='store_true')
+
+    # The compiled model written by training and read when classifying
+    parser.add_argument('-m',
+                        '--model',
+                        help="Path of the compiled model file.",
+                        required=False,
+                        default="bayes_model.bin")
+
+    # The compiled model can also be written out as a CSV of class, term and count
+    parser.add_argument('-csv',
+                        '--exportCsv',
+                        help="Also write the training counts to bayes_training.csv.",
+                        required=False,
+                        action='store_true')
+
     # Third is a collection of text from project Gutenberg
     parser.add_argument('-s',
                        '--stemming', help="Stem in the classifier or trainer.",
                        required=False,
                        action='store_true')
 
-    # Third is a collection of text from project Gutenberg
-    parser.add_argument('-lp',
-                       '--printProbabilities', help="Print each word probability.",
-                       required=False,
-                       action='store_true')
+    # Explain the classification as JSON: the top terms for each class and the margin to the runner up
+    parser.add_argument('-ex',
+                        '--explain',
+                        help="Print the terms that contribute most to each class as JSON.",
+                        required=False,
+                        action='store_true')
+
+    parser.add_argument('--explainTerms',
+                        help="Number of terms to explain for each class.",
+                        required=False,
+                        type=int,
+                        default=10)
 
 
     # Parse the passed commandline args and turn them into a dictionary.
     args = vars(parser.parse_args())
 
+    # Selecting no terms would leave every class with the same (undefined) score
+    if args["numFeatures"] < 1:
+        parser.error("--numFeatures must be at least 1")
+
     # Configure the log level based on passed in args to be one of DEBUG, INFO, WARN, ERROR, CRITICAL
     log.set_log_level_from_args(args)
 
@@ -0,0 +1,155 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# Requests wait on a queue until the batching thread picks them up
+import Queue
+
+# The batching thread and the events callers wait on
+import threading
+
+# Used to measure how long a batch has been collecting
+import time
+
+# Python logging allows us to log formatted log messages at different
+# log levels.
+import logging
+
+
+###############################################################################
+#
+# Collect documents from many threads and score them together.  Scoring a
+# batch of documents costs much less per document than scoring them one at a
+# time (see NaiveBayesModel.score_batch), but a server handles one request
+# per thread.  Each thread submits its document and gets back a pending
+# result right away.  A single batching thread takes the first waiting
+# document, then keeps collecting until it has max_batch_size documents or
+# max_wait seconds have passed, scores them all with one call to score_batch
+# and hands every caller its own result.
+#
+# score_batch is any function that takes a list of token lists and returns
+# one result per document, such as NaiveBayesModel.score_batch.
+#
+# We keep two histograms: how many documents were waiting when each batch
+# started, and how many documents went into each batch.
+#
+# Python 2 has no asyncio, so callers are threads and each gets a
+# PendingResult to wait on rather than a future.
+#
+###############################################################################
+
+class MicroBatcher(object):
+
+    def __init__(self, score_batch, max_batch_size=32, max_wait=0.005):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = Queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.queue_depths = {}
+        self.batch_sizes = {}
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, tokens):
+        pending = PendingResult()
+        self.queue.put((tokens, pending))
+        return pending
+
+    # Submit a document and wait for its result
+    def score(self, tokens, timeout=None):
+        return self.submit(tokens).result(timeout)
+
+    def stats(self):
+        with self.stats_lock:
+            return {"queue_depth": dict(self.queue_depths),
+                    "batch_size": dict(self.batch_sizes)}
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            queue_depth = self.queue.qsize() + 1
+
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            with self.stats_lock:
+                self.queue_depths[queue_depth] = self.queue_depths.get(queue_depth, 0) + 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+            self.score_pending(batch)
+
+    def score_pending(self, batch):
+        try:
+            results = self.score_batch([tokens for tokens, pending in batch])
+        except Exception as error:
+            logging.warn("Unable to score a batch of " + str(len(batch)) + " documents: " + str(error))
+            for tokens, pending in batch:
+                pending.set_error(error)
+            return
+
+        for (tokens, pending), result in zip(batch, results):
+            pending.set_result(result)
+
+
+###############################################################################
+#
+# The result of one submitted document.  result() blocks until the batch the
+# document went into has been scored, then returns its result or raises the
+# error scoring hit.
+#
+###############################################################################
+
+class PendingResult(object):
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise RuntimeError("Timed out waiting for a classification")
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,1193 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# The compiled model header is stored as JSON so it stays human readable
+import json
+
+# Used to write the model atomically and to check file sizes
+import os
+
+# Used to pack the fixed size preamble of the model file
+import struct
+
+# crc32 is a fast, stable hash we use for the term lookup table
+import zlib
+
+# The model file is memory mapped rather than read
+import mmap
+
+# Used for the log of the class priors
+import math
+
+# Python logging allows us to log formatted log messages at different
+# log levels.
+import logging
+
+# numpy gives us typed arrays that can be viewed directly over the mapped file
+import numpy
+
+
+###############################################################################
+#
+# The compiled model is a single binary file.  It starts with an 8 byte magic
+# string and the length of a JSON header.  The header holds everything small
+# about the model (class names, per-class term totals, the stopwords used
+# during training, the class statistics) along with the offset, dtype and
+# shape of every array.
+# The arrays themselves follow the header, each aligned to a 64 byte boundary,
+# so they can be viewed in place over a memory map without being parsed.
+#
+###############################################################################
+
+MODEL_MAGIC = b"NBMODEL1"
+
+MODEL_VERSION = 2
+
+ARRAY_ALIGNMENT = 64
+
+# Models with at least this many classes are scored through the inverted index
+INDEX_SCORING_CLASSES = 64
+
+
+###############################################################################
+#
+# Turn the per-class term counts collected during training into a compiled
+# model.  class_term_counts is a list of (class name, {term: count}) pairs.
+# Every distinct term across all classes gets an id (terms are sorted so the
+# ids are deterministic) and the counts become a single classes x vocabulary
+# matrix of unsigned 32 bit integers.
+#
+###############################################################################
+
+def compile_model(class_term_counts, stopwords, stemming):
+    class_names = [class_name for class_name, term_counts in class_term_counts]
+
+    vocabulary = {}
+    for class_name, term_counts in class_term_counts:
+        for term in term_counts:
+            vocabulary[term] = True
+
+    terms = sorted(vocabulary.keys())
+    term_ids = dict((term, term_id) for term_id, term in enumerate(terms))
+
+    counts = numpy.zeros((len(class_names), len(terms)), dtype=numpy.uint32)
+    for class_index, (class_name, term_counts) in enumerate(class_term_counts):
+        for term, count in term_counts.iteritems():
+            counts[class_index, term_ids[term]] = count
+
+    return build_model(class_names, terms, counts, stopwords, stemming)
+
+
+###############################################################################
+#
+# The hashing trick.  Rather than giving every distinct term its own column we
+# hash each term into one of a fixed number of buckets and count the bucket.
+# The size of the model is then set by the number of buckets, no matter how
+# large the vocabulary grows, at the cost of unrelated terms that land in the
+# same bucket sharing a count.  There is no term table; classify hashes each
+# term the same way to find its column.
+#
+# Terms are hashed as they are counted (see add_hashed_term_counts), so
+# training never holds more than one document's or chunk's terms at a time.
+# class_bucket_counts is a list of (class name, bucket counts) pairs.  As the
+# terms themselves are gone, the collision rate (the fraction of distinct
+# terms that had to share a bucket with an earlier term) is estimated from
+# how many buckets are in use: hashing n terms uniformly into N buckets
+# leaves about N(1 - 1/N)^n of them empty.
+#
+###############################################################################
+
+def compile_hashed_model(class_bucket_counts, stopwords, stemming, hash_buckets):
+    class_names = [class_name for class_name, bucket_counts in class_bucket_counts]
+
+    counts = numpy.zeros((len(class_names), hash_buckets), dtype=numpy.uint64)
+    for class_index, (class_name, bucket_counts) in enumerate(class_bucket_counts):
+        counts[class_index] = bucket_counts
+
+    if counts.size > 0 and counts.max() > numpy.iinfo(numpy.uint32).max:
+        raise ValueError("Hashed term counts overflow the model's 32 bit counts")
+
+    model = build_model(class_names, None, counts.astype(numpy.uint32), stopwords, stemming, hash_buckets)
+
+    occupied_buckets = model["vocabulary_size"]
+    hashed_terms = estimate_hashed_terms(occupied_buckets, hash_buckets)
+    model["hashed_terms"] = int(round(hashed_terms))
+    model["hash_collision_rate"] = 1.0 - occupied_buckets / max(hashed_terms, 1.0)
+
+    return model
+
+
+# Add each term's count to its bucket.  Returns the bucket counts.
+def add_hashed_term_counts(bucket_counts, term_counts):
+    if len(term_counts) == 0:
+        return bucket_counts
+
+    hash_buckets = len(bucket_counts)
+    term_count_pairs = term_counts.items()
+    buckets = numpy.fromiter((term_bucket(term, hash_buckets) for term, count in term_count_pairs),
+                             dtype=numpy.intp, count=len(term_count_pairs))
+    counts = numpy.fromiter((count for term, count in term_count_pairs),
+                            dtype=numpy.uint64, count=len(term_count_pairs))
+    numpy.add.at(bucket_counts, buckets, counts)
+
+    return bucket_counts
+
+
+# The number of distinct terms most likely to fill occupied_buckets buckets
+def estimate_hashed_terms(occupied_buckets, hash_buckets):
+    if occupied_buckets == 0 or hash_buckets <= 1:
+        return float(occupied_buckets)
+
+    # With every bucket in use we can only say there were at least this many
+    occupied_buckets = min(occupied_buckets, hash_buckets - 0.5)
+    return math.log1p(-float(occupied_buckets) / hash_buckets) / math.log1p(-1.0 / hash_buckets)
+
+
+def term_bucket(term, hash_buckets):
+    return (zlib.crc32(term_bytes(term)) & 0xffffffff) % hash_buckets
+
+
+###############################################################################
+#
+# Build the model from its class names, its (sorted) terms and the classes x
+# vocabulary matrix of counts.  Hashed models have no terms; their columns
+# are hash buckets and the vocabulary size is the number of buckets in use.
+# A pruned model passes in the class totals and vocabulary size of the model
+# it was pruned from, so the terms it keeps have the same probabilities.
+#
+###############################################################################
+
+def build_model(class_names, terms, counts, stopwords, stemming, hash_buckets=0,
+                class_totals=None, vocabulary_size=None):
+    if class_totals is None:
+        class_totals = [int(total) for total in counts.sum(axis=1, dtype=numpy.uint64)]
+
+    model = {
+        "version": MODEL_VERSION,
+        "classes": list(class_names),
+        "class_totals": list(class_totals),
+        "stemming": bool(stemming),
+        "stopwords": sorted(stopwords),
+        "counts": counts,
+    }
+
+    if hash_buckets:
+        model["hash_buckets"] = hash_buckets
+        model["vocabulary_size"] = int(numpy.count_nonzero(counts.any(axis=0)))
+    else:
+        model["vocabulary_size"] = len(terms)
+        model["term_offsets"], model["term_blob"], model["term_slots"] = build_term_table(terms)
+
+    if vocabulary_size is not None:
+        model["vocabulary_size"] = vocabulary_size
+
+    add_posting_index(model)
+
+    return add_class_statistics(model)
+
+
+###############################################################################
+#
+# Naive Bayes only needs counts, and counts can simply be added together.
+# That means models trained on different machines, different partitions of
+# the data or at different times can be merged into exactly the model we
+# would have got by training on all of the data at once.  Classes with the
+# same name are combined and the vocabulary becomes the union of all of the
+# vocabularies.  All of the models must agree on whether terms were stemmed.
+# If any of them kept only selected features, the merged model also ignores
+# terms outside its vocabulary rather than scoring them as unseen.
+#
+###############################################################################
+
+def merge_models(models):
+    if any(model.get("compacted", False) for model in models):
+        raise ValueError("Can't merge a pruned or quantized model; merge the full models and compact the result")
+
+    if len(set(model["stemming"] for model in models)) > 1:
+        raise ValueError("Can't merge stemmed and unstemmed models")
+
+    if len(set(model.get("hash_buckets", 0) for model in models)) > 1:
+        raise ValueError("Can't merge models with different numbers of hash buckets")
+
+    if models[0].get("hash_buckets", 0):
+        return merge_hashed_models(models)
+
+    class_names = []
+    stopwords = set()
+    vocabulary = {}
+    model_term_lists = []
+    for model in models:
+        for class_name in model["classes"]:
+            if class_name not in class_names:
+                class_names.append(class_name)
+
+        stopwords.update(model["stopwords"])
+
+        terms = model_terms(model)
+        model_term_lists.append(terms)
+        for term in terms:
+            vocabulary[term] = True
+
+    terms = sorted(vocabulary.keys())
+    term_ids = dict((term, term_id) for term_id, term in enumerate(terms))
+
+    # Add up in 64 bits so we can tell if any count no longer fits in 32
+    counts = numpy.zeros((len(class_names), len(terms)), dtype=numpy.uint64)
+    for model, model_term_list in zip(models, model_term_lists):
+        rows = numpy.array([class_names.index(class_name) for class_name in model["classes"]], dtype=numpy.intp)
+        columns = numpy.array([term_ids[term] for term in model_term_list], dtype=numpy.intp)
+        counts[numpy.ix_(rows, columns)] += model["counts"]
+
+    if counts.size > 0 and counts.max() > numpy.iinfo(numpy.uint32).max:
+        raise ValueError("Merged term counts overflow the model's 32 bit counts")
+
+    merged = build_model(class_names, terms, counts.astype(numpy.uint32), stopwords, models[0]["stemming"])
+
+    # If any of the models only kept selected features, so does the merged model
+    selection_methods = sorted(set(model["selected_features"] for model in models if "selected_features" in model))
+    if selection_methods:
+        merged["selected_features"] = ",".join(selection_methods)
+    if any(model.get("ignore_unknown_terms", False) for model in models):
+        merged["ignore_unknown_terms"] = True
+
+    return merged
+
+
+# Hashed models share their columns, so only the classes need lining up
+def merge_hashed_models(models):
+    class_names = []
+    stopwords = set()
+    for model in models:
+        for class_name in model["classes"]:
+            if class_name not in class_names:
+                class_names.append(class_name)
+        stopwords.update(model["stopwords"])
+
+    hash_buckets = models[0]["hash_buckets"]
+    counts = numpy.zeros((len(class_names), hash_buckets), dtype=numpy.uint64)
+    for model in models:
+        rows = numpy.array([class_names.index(class_name) for class_name in model["classes"]], dtype=numpy.intp)
+        counts[rows] += model["counts"]
+
+    if counts.size > 0 and counts.max() > numpy.iinfo(numpy.uint32).max:
+        raise ValueError("Merged term counts overflow the model's 32 bit counts")
+
+    return build_model(class_names, None, counts.astype(numpy.uint32), stopwords, models[0]["stemming"], hash_buckets)
+
+
+###############################################################################
+#
+# Precompute everything that scoring a document needs and that depends only on
+# the trained model.  We want P(c|w), the probability of a class given the
+# words of a document.  Bayes Theorem gives us P(c|w) = P(w|c) * P(c) / P(w),
+# and since P(w) is the same for every class we can drop it.  The Naive part
+# of the classifier is that P(w|c) is the product of the probability of each
+# individual word given the class.  We work with log probabilities so that the
+# product of many near-0 numbers becomes a sum that doesn't underflow.
+#
+# Each word probability uses laplace (add one) smoothing so that a word we
+# never saw in a class gets a very small probability rather than 0:
+#
+#   P(term|c) = (count(term, c) + 1) / (number of terms in c + vocabulary size)
+#
+# That gives us a classes x vocabulary matrix of log probabilities, plus the
+# per-class log probability of a term that is not in the vocabulary at all
+# (a count of 0).  In this example each class is a single corpus, so every
+# class has the same prior of 1 / the number of classes.
+#
+# None of this depends on the document being classified, so it is worked out
+# once when the model is built and saved along with the counts.  Classifying
+# a document then only has to do work proportional to the document.
+#
+# Models with many classes are scored through the inverted index, which
+# doesn't need the log probability matrix.  At 8 bytes per class per term it
+# would be by far the largest part of such a model, so we leave it out and
+# work out the columns we need from the counts instead (see
+# term_log_probabilities).
+#
+###############################################################################
+
+def add_class_statistics(model):
+    number_of_classes = len(model["classes"])
+    denominators = numpy.array(model["class_totals"], dtype=numpy.float64) + model["vocabulary_size"]
+    log_denominators = numpy.log(denominators)
+
+    model["denominators"] = denominators.tolist()
+    if number_of_classes < INDEX_SCORING_CLASSES:
+        model["log_probabilities"] = numpy.log(model["counts"] + 1.0) - log_denominators[:, numpy.newaxis]
+    model["unseen_log_probabilities"] = -log_denominators
+
+    # The least and most any single term can add to each class.  Used to bound
+    # scores when we stop scoring a document early.
+    add_log_probability_bounds(model)
+    model["log_priors"] = numpy.full(number_of_classes, math.log(1.0 / number_of_classes))
+
+    return model
+
+
+def add_log_probability_bounds(model):
+    unseen_log_probabilities = model["unseen_log_probabilities"]
+
+    if "log_probabilities" in model and model["log_probabilities"].shape[1] > 0:
+        log_probabilities = model["log_probabilities"]
+        model["min_log_probabilities"] = numpy.minimum(log_probabilities.min(axis=1), unseen_log_probabilities)
+        model["max_log_probabilities"] = numpy.maximum(log_probabilities.max(axis=1), unseen_log_probabilities)
+    elif model["counts"].shape[1] > 0:
+        # Without the matrix, the largest count of each class gives the upper
+        # bound, and no term is less likely than an unseen one
+        log_denominators = numpy.log(model["denominators"])
+        model["min_log_probabilities"] = numpy.array(unseen_log_probabilities, dtype=numpy.float64)
+        model["max_log_probabilities"] = numpy.log(model["counts"].max(axis=1) + 1.0) - log_denominators
+    else:
+        model["min_log_probabilities"] = numpy.array(unseen_log_probabilities, dtype=numpy.float64)
+        model["max_log_probabilities"] = numpy.array(unseen_log_probabilities, dtype=numpy.float64)
+
+    return model
+
+
+###############################################################################
+#
+# Shrink a trained model.  Terms that occur fewer than min_count times in
+# total are dropped, and if top_terms is set only that many of the remaining
+# terms are kept, ranked by information gain.  A dropped term is treated as
+# unseen when classifying.  The class totals and vocabulary size are those of
+# the full model, so the terms that are kept have exactly the probabilities
+# they had before.
+#
+# The arrays can then be stored in narrower types: counts as uint16 (counts
+# above 65535 are capped, the class totals are unaffected) and the log
+# probabilities as float32 or float16.  Scores are still added up in 64 bits.
+# A compacted model is marked as such and can't be merged or updated, since
+# its counts no longer add up to its class totals.
+#
+###############################################################################
+
+def compact_model(model, min_count=0, top_terms=0, count_dtype="uint32", log_probability_dtype="float64"):
+    if min_count > 0 or top_terms > 0:
+        if model.get("hash_buckets", 0):
+            raise ValueError("Terms can't be pruned from a hashed model")
+
+        term_totals = model["counts"].sum(axis=0, dtype=numpy.uint64)
+        keep = term_totals >= min_count
+
+        if top_terms > 0 and numpy.count_nonzero(keep) > top_terms:
+            gains = information_gain(model["counts"])
+            gains[~keep] = -numpy.inf
+            kept_ids = numpy.sort(numpy.argsort(-gains, kind="mergesort")[:top_terms])
+        else:
+            kept_ids = numpy.nonzero(keep)[0]
+
+        terms = model_terms(model)
+        compacted = build_model(model["classes"],
+                                [terms[term_index] for term_index in kept_ids],
+                                numpy.array(model["counts"][:, kept_ids]),
+                                model["stopwords"],
+                                model["stemming"],
+                                class_totals=model["class_totals"],
+                                vocabulary_size=model["vocabulary_size"])
+
+        # A model that only kept selected features still ignores every other term
+        if "selected_features" in model:
+            compacted["selected_features"] = model["selected_features"]
+        if model.get("ignore_unknown_terms", False):
+            compacted["ignore_unknown_terms"] = True
+    else:
+        compacted = dict(model)
+
+    count_dtype = numpy.dtype(count_dtype)
+    if count_dtype != compacted["counts"].dtype:
+        compacted["counts"] = numpy.minimum(compacted["counts"], numpy.iinfo(count_dtype).max).astype(count_dtype)
+
+    log_probability_dtype = numpy.dtype(log_probability_dtype)
+    if log_probability_dtype != compacted["posting_weights"].dtype:
+        if "log_probabilities" in compacted:
+            compacted["log_probabilities"] = compacted["log_probabilities"].astype(log_probability_dtype)
+        compacted["posting_weights"] = compacted["posting_weights"].astype(log_probability_dtype)
+        add_log_probability_bounds(compacted)
+
+    # The counts no longer add up to the class totals, so the model can't be merged
+    compacted["compacted"] = True
+
+    return compacted
+
+
+###############################################################################
+#
+# Feature selection.  Only the number_of_features terms that best tell the
+# classes apart are kept, ranked either by chi-square ("chi2") or by mutual
+# information ("mi").  Unlike pruning, the model is rebuilt over just the
+# selected terms and every other term is ignored when classifying, rather
+# than being scored as unseen.  A document's unselected terms are dropped
+# before any per-class work is done.
+#
+###############################################################################
+
+def select_features(model, method, number_of_features):
+    if model.get("hash_buckets", 0):
+        raise ValueError("Features can't be selected from a hashed model")
+
+    if number_of_features < 1:
+        raise ValueError("At least one feature must be selected")
+
+    if method == "chi2":
+        scores = chi_square(model["counts"])
+    elif method == "mi":
+        scores = information_gain(model["counts"])
+    else:
+        raise ValueError("Unknown feature selection method " + method)
+
+    selected_ids = numpy.sort(numpy.argsort(-scores, kind="mergesort")[:number_of_features])
+
+    terms = model_terms(model)
+    selected = build_model(model["classes"],
+                           [terms[term_index] for term_index in selected_ids],
+                           numpy.array(model["counts"][:, selected_ids]),
+                           model["stopwords"],
+                           model["stemming"])
+    selected["selected_features"] = method
+    selected["ignore_unknown_terms"] = True
+
+    return selected
+
+
+###############################################################################
+#
+# The chi-square statistic tests whether a term occurring is independent of
+# the class.  For each term and class we build the 2x2 table of tokens that
+# are / aren't the term in / outside the class:
+#
+#   A = term in class, B = term outside class,
+#   C = other terms in class, D = other terms outside class
+#
+#   chi2(t, c) = N (AD - BC)^2 / ((A + B)(C + D)(A + C)(B + D))
+#
+# A term's score is its largest chi-square across the classes.
+#
+###############################################################################
+
+def chi_square(counts):
+    counts = counts.astype(numpy.float64)
+    class_totals = counts.sum(axis=1)[:, numpy.newaxis]
+    term_totals = counts.sum(axis=0)[numpy.newaxis, :]
+    total = class_totals.sum()
+
+    a = counts
+    b = term_totals - a
+    c = class_totals - a
+    d = total - a - b - c
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        scores = total * (a * d - b * c) ** 2 / ((a + b) * (c + d) * (a + c) * (b + d))
+
+    return numpy.nan_to_num(scores).max(axis=0) if counts.shape[0] > 0 else numpy.zeros(counts.shape[1])
+
+
+###############################################################################
+#
+# Information gain measures how much knowing whether a term occurred tells us
+# about the class.  Treating each token in the training data as an event,
+# it's the entropy of the class distribution less the expected entropy once
+# we know whether the token is the term:
+#
+#   IG(t) = H(C) - P(t) H(C|t) - P(not t) H(C|not t)
+#
+# Returns the information gain of every term (column) of the counts.
+#
+###############################################################################
+
+def information_gain(counts):
+    counts = counts.astype(numpy.float64)
+    class_totals = counts.sum(axis=1)
+    total = class_totals.sum()
+    term_totals = counts.sum(axis=0)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        class_given_term = counts / term_totals
+        class_given_not_term = (class_totals[:, numpy.newaxis] - counts) / (total - term_totals)
+
+    probability_of_term = term_totals / total
+    class_entropy = entropy(class_totals / total, axis=0)
+
+    return (class_entropy
+            - probability_of_term * entropy(class_given_term, axis=0)
+            - (1.0 - probability_of_term) * entropy(class_given_not_term, axis=0))
+
+
+# Entropy in bits, treating 0 log 0 (and anything undefined) as 0
+def entropy(probabilities, axis):
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        terms = probabilities * numpy.log2(probabilities)
+    return -numpy.nan_to_num(terms).sum(axis=axis)
+
+
+###############################################################################
+#
+# Most terms only occur in a handful of classes, so alongside the dense
+# matrix we keep an inverted index: for each term, the classes it occurs in
+# (its posting list) and how much it adds to each of them.  Because
+#
+#   log P(term|c) = log(count + 1) - log(denominator of c)
+#
+# and an unseen term is log(1) - log(denominator of c), a term that occurs
+# count times in class c adds exactly log(count + 1) on top of the class's
+# unseen term log probability.  That is the weight stored with each posting.
+# The postings for term t are at posting_offsets[t] to posting_offsets[t + 1].
+#
+###############################################################################
+
+def add_posting_index(model):
+    counts = model["counts"]
+    number_of_columns = counts.shape[1]
+    posting_terms, posting_classes = numpy.nonzero(counts.T)
+
+    posting_offsets = numpy.zeros(number_of_columns + 1, dtype=numpy.uint64)
+    posting_offsets[1:] = numpy.cumsum(numpy.bincount(posting_terms, minlength=number_of_columns))
+
+    model["posting_offsets"] = posting_offsets
+    model["posting_classes"] = posting_classes.astype(numpy.uint32)
+    model["posting_weights"] = numpy.log1p(counts[posting_classes, posting_terms].astype(numpy.float64))
+
+    return model
+
+
+###############################################################################
+#
+# Turn the terms of a document into a sparse term count vector.  Each term is
+# lowercased and stop words and punctuation are dropped (just like during
+# training), then we count each distinct term once and look up its id.  We
+# return the ids of the known terms (sorted, so the matrix columns are read in
+# order), how many times each occurred and the number of unknown terms.
+#
+###############################################################################
+
+def document_term_vector(model, terms, stopwords):
+    document_counts = {}
+    for term in terms:
+
+        # Treat capitalized and lowercase as a single term
+        term = term.lower()
+
+        # We ignore stop words and punctuation
+        if term not in stopwords and term.isalnum():
+            document_counts[term] = document_counts.get(term, 0) + 1
+
+    # Models built with feature selection ignore every term they don't know
+    ignore_unknown_terms = model.get("ignore_unknown_terms", False)
+
+    term_ids = []
+    term_counts = []
+    unknown_count = 0
+    for term, count in document_counts.iteritems():
+        term_index = term_id(model, term)
+        if term_index >= 0:
+            term_ids.append(term_index)
+            term_counts.append(count)
+        elif not ignore_unknown_terms:
+            unknown_count += count
+
+    term_ids = numpy.array(term_ids, dtype=numpy.intp)
+    term_counts = numpy.array(term_counts, dtype=numpy.float64)
+    order = numpy.argsort(term_ids)
+
+    return term_ids[order], term_counts[order], unknown_count
+
+
+###############################################################################
+#
+# Score every class with one matrix-vector product.  The log probability of
+# the document given a class is the sum over its terms of count * log P(term|c)
+# which is exactly the dot product of the selected matrix columns with the
+# term counts.  Unknown terms all share the same per-class log probability.
+# Models with many classes are scored through the inverted index instead
+# (see score_document_index), which gives the same result.
+#
+###############################################################################
+
+def score_document(model, term_ids, term_counts, unknown_count):
+    if len(model["classes"]) >= INDEX_SCORING_CLASSES:
+        return score_document_index(model, term_ids, term_counts, unknown_count)
+
+    return score_document_dense(model, term_ids, term_counts, unknown_count)
+
+
+def score_document_dense(model, term_ids, term_counts, unknown_count):
+    return (model["log_priors"]
+            + model["unseen_log_probabilities"] * unknown_count
+            + term_log_probabilities(model, term_ids).dot(term_counts))
+
+
+###############################################################################
+#
+# The log probability of each of the given terms for every class, as a
+# classes x terms array.  The columns come straight from the log probability
+# matrix when the model has one, or are worked out from the counts when it
+# doesn't (see add_class_statistics).
+#
+###############################################################################
+
+def term_log_probabilities(model, term_ids):
+    if "log_probabilities" in model:
+        return model["log_probabilities"][:, term_ids]
+
+    log_denominators = numpy.log(model["denominators"])
+    return numpy.log(model["counts"][:, term_ids] + 1.0) - log_denominators[:, numpy.newaxis]
+
+
+###############################################################################
+#
+# Score every class using the inverted index.  Every class starts from its
+# "all unseen" baseline: the prior plus the unseen term log probability for
+# every term in the document.  Then, for each term in the document, only the
+# classes in its posting list are adjusted by count * weight.  The cost
+# depends on the number of postings touched rather than on the number of
+# classes times the number of terms.  The result is the same as
+# score_document_dense.
+#
+###############################################################################
+
+def score_document_index(model, term_ids, term_counts, unknown_count):
+    number_of_terms = term_counts.sum() + unknown_count
+    class_probabilities = model["log_priors"] + model["unseen_log_probabilities"] * number_of_terms
+
+    posting_offsets = model["posting_offsets"]
+    starts = posting_offsets[term_ids].astype(numpy.intp)
+    lengths = posting_offsets[term_ids + 1].astype(numpy.intp) - starts
+    number_of_postings = int(lengths.sum())
+    if number_of_postings == 0:
+        return class_probabilities
+
+    # The positions of every posting for every term in the document, laid end to end
+    first_positions = numpy.cumsum(lengths) - lengths
+    positions = numpy.arange(number_of_postings) + numpy.repeat(starts - first_positions, lengths)
+
+    weights = model["posting_weights"][positions] * numpy.repeat(term_counts, lengths)
+    class_probabilities += numpy.bincount(model["posting_classes"][positions],
+                                          weights=weights,
+                                          minlength=len(model["classes"]))
+
+    return class_probabilities
+
+
+###############################################################################
+#
+# Score many documents at once.  document_vectors is a list of (term ids,
+# term counts, unknown count) from document_term_vector.  The known terms of
+# every document are laid end to end so the matrix columns for the whole
+# batch are gathered and weighted in one go, then summed back per document.
+# Returns a documents x classes matrix of log probabilities, the same as
+# calling score_document for each document.
+#
+###############################################################################
+
+def score_documents(model, document_vectors):
+    number_of_documents = len(document_vectors)
+    number_of_classes = len(model["classes"])
+    class_probabilities = numpy.empty((number_of_documents, number_of_classes), dtype=numpy.float64)
+    if number_of_documents == 0:
+        return class_probabilities
+
+    if number_of_classes >= INDEX_SCORING_CLASSES:
+        for document_index, (term_ids, term_counts, unknown_count) in enumerate(document_vectors):
+            class_probabilities[document_index] = score_document_index(model, term_ids, term_counts, unknown_count)
+        return class_probabilities
+
+    lengths = numpy.array([len(term_ids) for term_ids, term_counts, unknown_count in document_vectors], dtype=numpy.intp)
+    unknown_counts = numpy.array([unknown_count for term_ids, term_counts, unknown_count in document_vectors], dtype=numpy.float64)
+
+    class_probabilities[:] = model["log_priors"]
+    class_probabilities += numpy.outer(unknown_counts, model["unseen_log_probabilities"])
+
+    if lengths.sum() > 0:
+        all_term_ids = numpy.concatenate([term_ids for term_ids, term_counts, unknown_count in document_vectors])
+        all_term_counts = numpy.concatenate([term_counts for term_ids, term_counts, unknown_count in document_vectors])
+
+        # A trailing zero column lets documents without known terms point past the end
+        weighted = numpy.zeros((number_of_classes, len(all_term_ids) + 1), dtype=numpy.float64)
+        weighted[:, :-1] = term_log_probabilities(model, all_term_ids) * all_term_counts
+
+        starts = numpy.cumsum(lengths) - lengths
+        document_sums = numpy.add.reduceat(weighted, starts, axis=1)
+        document_sums[:, lengths == 0] = 0.0
+        class_probabilities += document_sums.T
+
+    return class_probabilities
+
+
+###############################################################################
+#
+# Explain how a document was classified.  The contribution of every known
+# term to every class is gathered into one classes x terms array, the same
+# way score_document_dense scores it: count * log P(term|class).  Every one
+# of those is negative, so what tells the classes apart is how far a term's
+# log probability for a class is above its average over all classes.  For
+# each class we keep only the top_terms terms that pull the document towards
+# it the most.  We also report the winning class and its margin over the
+# runner up.
+#
+###############################################################################
+
+def explain_document(model, term_ids, term_counts, unknown_count, top_terms):
+    class_names = model["classes"]
+    class_probabilities = score_document(model, term_ids, term_counts, unknown_count)
+    order = numpy.argsort(-class_probabilities, kind="mergesort")
+
+    log_probabilities = numpy.asarray(term_log_probabilities(model, term_ids), dtype=numpy.float64)
+    contributions = log_probabilities * term_counts
+    if len(class_names) > 1:
+        relative_contributions = (log_probabilities - log_probabilities.mean(axis=0)) * term_counts
+    else:
+        relative_contributions = contributions
+
+    number_of_terms = min(top_terms, len(term_ids))
+    classes = {}
+    for class_index, class_name in enumerate(class_names):
+        top_indices = numpy.argsort(-relative_contributions[class_index], kind="mergesort")[:number_of_terms]
+        classes[class_name] = {
+            "log_probability": float(class_probabilities[class_index]),
+            "top_terms": [{"term": term_for_id(model, term_ids[term_index]),
+                           "count": int(term_counts[term_index]),
+                           "contribution": float(contributions[class_index, term_index]),
+                           "relative_contribution": float(relative_contributions[class_index, term_index])}
+                          for term_index in top_indices]}
+
+    explanation = {"class": class_names[order[0]],
+                   "log_probability": float(class_probabilities[order[0]]),
+                   "known_terms": int(term_counts.sum()),
+                   "unknown_terms": unknown_count,
+                   "runner_up": None,
+                   "margin": None,
+                   "classes": classes}
+    if len(class_names) > 1:
+        explanation["runner_up"] = class_names[order[1]]
+        explanation["margin"] = float(class_probabilities[order[0]] - class_probabilities[order[1]])
+
+    return explanation
+
+
+###############################################################################
+#
+# Like document_term_vector, but keeps the terms of the document in their
+# original order.  Returns the id of each term, or -1 if we have never seen
+# it, as a single array.
+#
+###############################################################################
+
+def document_term_sequence(model, terms, stopwords):
+    ignore_unknown_terms = model.get("ignore_unknown_terms", False)
+
+    known_ids = {}
+    term_sequence = []
+    for term in terms:
+
+        # Treat capitalized and lowercase as a single term
+        term = term.lower()
+
+        # We ignore stop words and punctuation
+        if term not in stopwords and term.isalnum():
+            if term not in known_ids:
+                known_ids[term] = term_id(model, term)
+            if known_ids[term] >= 0 or not ignore_unknown_terms:
+                term_sequence.append(known_ids[term])
+
+    return numpy.array(term_sequence, dtype=numpy.intp)
+
+
+###############################################################################
+#
+# Score a document a chunk of terms at a time and stop as soon as the class
+# in the lead can no longer be caught.  Every term adds at least the class's
+# unseen term log probability (a count of 0) and at most its largest term log
+# probability.  After each chunk we assume the worst for the leader and the
+# best for every other class over the terms we haven't scored yet.  If the
+# leader still comes out strictly ahead, no ordering of the remaining terms
+# can change the winner, so we only finish the leader's own score.  The
+# class and log probability returned are the same as scoring the whole
+# document.  We also return how many terms were scored for every class.
+#
+###############################################################################
+
+def score_document_early_exit(model, term_sequence, chunk_size):
+    unseen_log_probabilities = model["unseen_log_probabilities"]
+    min_log_probabilities = model.get("min_log_probabilities", unseen_log_probabilities)
+    max_log_probabilities = model["max_log_probabilities"]
+
+    class_probabilities = numpy.array(model["log_priors"], dtype=numpy.float64)
+    number_of_terms = len(term_sequence)
+
+    end = 0
+    while end < number_of_terms:
+        chunk = term_sequence[end:end + chunk_size]
+        end += len(chunk)
+
+        known = chunk[chunk >= 0]
+        class_probabilities += term_log_probabilities(model, known).sum(axis=1, dtype=numpy.float64)
+        class_probabilities += unseen_log_probabilities * (len(chunk) - len(known))
+
+        remaining = number_of_terms - end
+        leader = int(numpy.argmax(class_probabilities))
+        worst_for_leader = class_probabilities[leader] + remaining * min_log_probabilities[leader]
+        best_for_others = class_probabilities + remaining * max_log_probabilities
+        best_for_others[leader] = -numpy.inf
+
+        if remaining > 0 and worst_for_leader > best_for_others.max():
+            break
+
+    leader = int(numpy.argmax(class_probabilities))
+    rest = term_sequence[end:]
+    known = rest[rest >= 0]
+    log_probability = (class_probabilities[leader]
+                       + term_log_probabilities(model, known)[leader].sum(dtype=numpy.float64)
+                       + unseen_log_probabilities[leader] * (len(rest) - len(known)))
+
+    return model["classes"][leader], float(log_probability), end
+
+
+###############################################################################
+#
+# Score the terms of one document against the model and return the most
+# probable class along with its log probability.
+#
+###############################################################################
+
+def classify_terms(model, stopwords, terms):
+    term_ids, term_counts, unknown_count = document_term_vector(model, terms, stopwords)
+    class_probabilities = score_document(model, term_ids, term_counts, unknown_count)
+    return most_probable_class(model, class_probabilities)
+
+
+###############################################################################
+#
+# We now have a bunch of probabilities, one per class.  We simply take the
+# class associated with the highest probability and label the document as
+# belonging to that class.
+#
+###############################################################################
+
+def most_probable_class(model, class_probabilities):
+    max_index = int(numpy.argmax(class_probabilities))
+    return model["classes"][max_index], float(class_probabilities[max_index])
+
+
+###############################################################################
+#
+# The term table lets us go from a term to its id without building a Python
+# dictionary at load time.  All of the terms are concatenated (as utf-8) into
+# one blob, with an offsets array marking where each begins.  An open
+# addressing hash table, keyed on the crc32 of the term, maps to term ids.  The
+# table is at least twice the size of the vocabulary so probes stay short.
+#
+###############################################################################
+
+def build_term_table(terms):
+    encoded_terms = [term_bytes(term) for term in terms]
+
+    term_offsets = numpy.zeros(len(encoded_terms) + 1, dtype=numpy.uint64)
+    if len(encoded_terms) > 0:
+        term_offsets[1:] = numpy.cumsum([len(encoded) for encoded in encoded_terms])
+
+    term_blob = numpy.frombuffer(b"".join(encoded_terms), dtype=numpy.uint8).copy()
+
+    table_size = 16
+    while table_size < 2 * len(encoded_terms):
+        table_size *= 2
+    mask = table_size - 1
+
+    slots = [-1] * table_size
+    for term_id, encoded in enumerate(encoded_terms):
+        slot = zlib.crc32(encoded) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = term_id
+
+    return term_offsets, term_blob, numpy.array(slots, dtype=numpy.int32)
+
+
+###############################################################################
+#
+# Look up the id of a term.  Returns -1 for terms that were never seen during
+# training.  In a hashed model the id is the term's bucket.
+#
+###############################################################################
+
+def term_id(model, term):
+    if model.get("hash_buckets", 0):
+        return term_bucket(term, model["hash_buckets"])
+
+    encoded = term_bytes(term)
+    slots = model["term_slots"]
+    offsets = model["term_offsets"]
+    blob = model["term_blob"]
+    mask = len(slots) - 1
+
+    slot = zlib.crc32(encoded) & mask
+    while True:
+        candidate = int(slots[slot])
+        if candidate < 0:
+            return -1
+        if blob[int(offsets[candidate]):int(offsets[candidate + 1])].tobytes() == encoded:
+            return candidate
+        slot = (slot + 1) & mask
+
+
+###############################################################################
+#
+# Return every term in the model, in id order.
+#
+###############################################################################
+
+def model_terms(model):
+    blob = model["term_blob"].tobytes()
+    offsets = model["term_offsets"].tolist()
+    return [blob[offsets[index]:offsets[index + 1]].decode("utf-8") for index in range(len(offsets) - 1)]
+
+
+###############################################################################
+#
+# Return the term with the given id.
+#
+###############################################################################
+
+def term_for_id(model, term_index):
+    if model.get("hash_buckets", 0):
+        return u"#%d" % term_index
+
+    offsets = model["term_offsets"]
+    encoded = model["term_blob"][int(offsets[term_index]):int(offsets[term_index + 1])].tobytes()
+    return encoded.decode("utf-8")
+
+
+###############################################################################
+#
+# Terms may arrive as unicode or as already encoded strings.  Everything in
+# the term table is utf-8.
+#
+###############################################################################
+
+def term_bytes(term):
+    if isinstance(term, bytes):
+        return term
+    return term.encode("utf-8")
+
+
+###############################################################################
+#
+# Write the model to disk.  Every numpy array in the model is written as a raw
+# aligned block and everything else goes into the JSON header.  We write to a
+# temporary file and rename it over the target so that anything reading the
+# model never sees a half written file.
+#
+###############################################################################
+
+def save_model(file_name, model):
+    layout = model_layout(model)
+
+    temporary_file_name = file_name + ".tmp"
+    with open(temporary_file_name, "wb") as model_file:
+        write_model(model_file, layout)
+
+    os.rename(temporary_file_name, file_name)
+
+    logging.debug("Wrote model to " + file_name + " (" + str(os.path.getsize(file_name)) + " bytes)")
+
+
+###############################################################################
+#
+# Work out where everything goes before writing anything.  Returns the
+# encoded header, the arrays with their offsets and the total size in bytes.
+#
+###############################################################################
+
+def model_layout(model):
+    header = {}
+    arrays = []
+    for key in sorted(model.keys()):
+        value = model[key]
+        if isinstance(value, numpy.ndarray):
+            arrays.append((key, numpy.ascontiguousarray(value)))
+        else:
+            header[key] = value
+
+    array_headers = {}
+    offset = 0
+    for name, array in arrays:
+        offset = aligned(offset)
+        array_headers[name] = {"offset": offset,
+                               "dtype": array.dtype.newbyteorder("<").str,
+                               "shape": list(array.shape)}
+        offset += array.nbytes
+    header["arrays"] = array_headers
+
+    encoded_header = json.dumps(header, sort_keys=True).encode("utf-8")
+    preamble_length = aligned(len(MODEL_MAGIC) + 8 + len(encoded_header))
+
+    return {"encoded_header": encoded_header,
+            "arrays": arrays,
+            "array_headers": array_headers,
+            "preamble_length": preamble_length,
+            "size": preamble_length + offset}
+
+
+def write_model(model_file, layout):
+    encoded_header = layout["encoded_header"]
+    array_headers = layout["array_headers"]
+
+    model_file.write(MODEL_MAGIC)
+    model_file.write(struct.pack("<Q", len(encoded_header)))
+    model_file.write(encoded_header)
+    model_file.write(b"\0" * (layout["preamble_length"] - len(MODEL_MAGIC) - 8 - len(encoded_header)))
+
+    position = 0
+    for name, array in layout["arrays"]:
+        padding = array_headers[name]["offset"] - position
+        model_file.write(b"\0" * padding)
+        model_file.write(array.astype(array_headers[name]["dtype"], copy=False).tobytes())
+        position = array_headers[name]["offset"] + array.nbytes
+
+
+###############################################################################
+#
+# Load the model by memory mapping the file.  Only the JSON header is parsed;
+# every array is a read only numpy view over the mapping, so load time does
+# not depend on the size of the vocabulary and pages are only read from disk
+# when scoring actually touches them.
+#
+###############################################################################
+
+def load_model(file_name):
+    return load_model_buffer(map_model_file(file_name))
+
+
+def map_model_file(file_name):
+    with open(file_name, "rb") as model_file:
+        buffer = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[0:len(MODEL_MAGIC)] != MODEL_MAGIC:
+        raise ValueError(file_name + " is not a compiled Naive Bayes model")
+
+    return buffer
+
+
+###############################################################################
+#
+# View a model laid out in the file format over any buffer, such as a memory
+# mapped file or the shared memory from share_model.
+#
+###############################################################################
+
+def load_model_buffer(buffer):
+    if buffer[0:len(MODEL_MAGIC)] != MODEL_MAGIC:
+        raise ValueError("Not a compiled Naive Bayes model")
+
+    header_length = struct.unpack("<Q", buffer[len(MODEL_MAGIC):len(MODEL_MAGIC) + 8])[0]
+    header_start = len(MODEL_MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_length].decode("utf-8"))
+    data_start = aligned(header_start + header_length)
+
+    if header["version"] not in (1, MODEL_VERSION):
+        raise ValueError("Unsupported model version " + str(header["version"]))
+
+    model = dict((key, value) for key, value in header.iteritems() if key != "arrays")
+    for name, array_header in header["arrays"].iteritems():
+        dtype = numpy.dtype(str(array_header["dtype"]))
+        shape = tuple(array_header["shape"])
+        count = int(numpy.prod(shape)) if len(shape) > 0 else 1
+        array = numpy.frombuffer(buffer, dtype=dtype, count=count,
+                                 offset=data_start + array_header["offset"])
+        model[name] = array.reshape(shape)
+
+    # Version 1 models were saved without their class statistics
+    if header["version"] == 1:
+        add_posting_index(model)
+        add_class_statistics(model)
+
+    else:
+        # The posting index and early exit bounds were added to the version 2
+        # format after it was first written, so older version 2 files are
+        # missing them
+        if "posting_offsets" not in model:
+            add_posting_index(model)
+        if "min_log_probabilities" not in model or "max_log_probabilities" not in model:
+            add_log_probability_bounds(model)
+
+    return model
+
+
+###############################################################################
+#
+# Copy the model into anonymous shared memory.  Processes forked after this
+# (such as the workers of a multiprocessing pool) inherit the mapping, so
+# viewing the model with load_model_buffer in each of them shares a single
+# physical copy of every array, including any computed in memory rather than
+# read from a file (version 1 models, freshly compiled models).  The process
+# that calls this owns the memory and closes it once its workers are done;
+# nothing may use the model views after that.
+#
+###############################################################################
+
+def share_model(model):
+    if model.get("version", MODEL_VERSION) == 1:
+        model = dict(model, version=MODEL_VERSION)
+
+    layout = model_layout(model)
+    buffer = mmap.mmap(-1, layout["size"])
+    write_model(buffer, layout)
+    buffer.seek(0)
+
+    return buffer
+
+
+###############################################################################
+#
+# Share a model file with processes forked after this.  A model that is read
+# straight from its file is shared through the file's own read only mapping,
+# so every process views the one copy in the page cache.  Only a model that
+# has arrays worked out in memory when it is loaded (version 1 files, and
+# older version 2 files missing their index or bounds) is copied into
+# anonymous shared memory with share_model, so those arrays are shared too.
+# Either way the caller owns the returned buffer, views it with
+# load_model_buffer and closes it once its workers are done.
+#
+###############################################################################
+
+def share_model_file(file_name):
+    buffer = map_model_file(file_name)
+    model = load_model_buffer(buffer)
+    if model_in_buffer(model, buffer):
+        return buffer
+
+    shared_buffer = share_model(model)
+    del model
+    buffer.close()
+
+    return shared_buffer
+
+
+# Whether every array of the model is a view over the buffer
+def model_in_buffer(model, buffer):
+    buffer_bytes = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    return all(numpy.may_share_memory(value, buffer_bytes)
+               for value in model.itervalues() if isinstance(value, numpy.ndarray) and value.size > 0)
+
+
+def aligned(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
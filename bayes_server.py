@@ -0,0 +1,262 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# The HTTP server and request handler come from the standard library
+import BaseHTTPServer
+import SocketServer
+
+# Requests and responses are JSON
+import json
+
+# Used to watch the model file and clean up the unix socket
+import os
+
+# The model is reloaded by a background thread
+import threading
+
+# Used to measure per request latency and to pace the model watcher
+import time
+
+# Python logging allows us to log formatted log messages at different
+# log levels.
+import logging
+
+# Used for tokenizing
+import nltk
+
+# The classifier itself
+from naive_bayes import NaiveBayesModel
+
+# Scores documents from concurrent requests together
+from bayes_batching import MicroBatcher
+
+
+###############################################################################
+#
+# Run a long lived classification server.  The model is loaded once and
+# stays warm, so a request only pays for tokenizing and scoring its own
+# documents.  The server listens for HTTP on a TCP port, or on a unix socket
+# if one is given, and handles each request on its own thread.  A background
+# thread watches the model file and swaps in a freshly loaded model when it
+# changes.  Training replaces the model file with a rename, and requests pick
+# up the classifier once when they start, so a request is always scored
+# entirely against either the old or the new model.
+#
+# POST /classify accepts {"text": "..."} for a single document or
+# {"documents": ["...", ...]} for a batch.  GET /health describes the model
+# that is currently loaded.
+#
+# With a batch size above one, single documents from concurrent requests are
+# collected for up to batchWait milliseconds and scored together (see
+# bayes_batching).  GET /stats returns the queue depth and batch size
+# histograms.
+#
+###############################################################################
+
+def serve(args):
+    if args["socket"] is not None:
+        if os.path.exists(args["socket"]):
+            os.remove(args["socket"])
+        server = ThreadingUnixHTTPServer(args["socket"], ClassificationRequestHandler)
+        address = args["socket"]
+    else:
+        server = ThreadingHTTPServer((args["host"], int(args["port"])), ClassificationRequestHandler)
+        address = args["host"] + ":" + str(args["port"])
+
+    # Stemming follows the model file unless it is forced on
+    stemming = args["stemming"] or None
+    server.classifier = load_classifier(args["model"], stemming)
+
+    # Each batch is scored with whichever model is loaded when it is ready
+    server.batcher = None
+    if int(args["batchSize"]) > 1:
+        server.batcher = MicroBatcher(lambda list_of_tokens: server.classifier["model"].score_batch(list_of_tokens),
+                                      int(args["batchSize"]),
+                                      float(args["batchWait"]) / 1000.0)
+
+    watcher = threading.Thread(target=watch_model_file,
+                               args=(server, args["model"], stemming, float(args["reloadInterval"])))
+    watcher.daemon = True
+    watcher.start()
+
+    logging.warn("Serving classifications on " + address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args["socket"] is not None and os.path.exists(args["socket"]):
+            os.remove(args["socket"])
+
+
+###############################################################################
+#
+# Everything a request needs to classify documents.  A new one of these is
+# built whenever the model file changes and then swapped in as a whole.
+#
+###############################################################################
+
+def load_classifier(model_file_name, stemming):
+    # Stat before loading: if the file is replaced in between we load the new
+    # model under the old time and just load it again on the next poll,
+    # rather than keeping the old model under the new time for good
+    modified = os.stat(model_file_name).st_mtime
+    model = NaiveBayesModel.load(model_file_name, stemming)
+    logging.info("Loaded model " + model_file_name + " with " + str(len(model.classes)) + " classes")
+
+    return {
+        "model": model,
+        "modified": modified,
+    }
+
+
+###############################################################################
+#
+# Poll the model file and reload it when its modification time changes.  If
+# the new file can't be loaded we keep serving the old model.
+#
+###############################################################################
+
+def watch_model_file(server, model_file_name, stemming, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if os.stat(model_file_name).st_mtime != server.classifier["modified"]:
+                server.classifier = load_classifier(model_file_name, stemming)
+        except (OSError, IOError, ValueError) as error:
+            logging.warn("Unable to reload " + model_file_name + ": " + str(error))
+
+
+###############################################################################
+#
+# Tokenize, stem and score one document.
+#
+###############################################################################
+
+def classify_text(classifier, text, batcher=None):
+    tokens = nltk.word_tokenize(text)
+    if batcher is not None:
+        class_name, log_probability = batcher.score(tokens)
+    else:
+        class_name, log_probability = classifier["model"].score(tokens)
+    return {"class": class_name, "log_probability": log_probability}
+
+
+###############################################################################
+#
+# Check that a decoded request is something we can classify: an object with
+# either a "text" string or a "documents" list of strings.  Returns a
+# description of the problem, or None if the request is fine.
+#
+###############################################################################
+
+def request_error(request):
+    if not isinstance(request, dict):
+        return "Expected a JSON object"
+
+    if "documents" in request:
+        documents = request["documents"]
+        if not isinstance(documents, list) or not all(isinstance(text, basestring) for text in documents):
+            return "Expected documents to be a list of strings"
+    elif "text" in request:
+        if not isinstance(request["text"], basestring):
+            return "Expected text to be a string"
+    else:
+        return "Expected text or documents"
+
+    return None
+
+
+class ClassificationRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/stats":
+            batcher = self.server.batcher
+            self.send_json(200, batcher.stats() if batcher is not None else {})
+            return
+
+        if self.path != "/health":
+            self.send_json(404, {"error": "Unknown path " + self.path})
+            return
+
+        model = self.server.classifier["model"]
+        self.send_json(200, {"classes": list(model.classes),
+                             "vocabulary_size": model.vocabulary_size})
+
+    def do_POST(self):
+        start = time.time()
+
+        if self.path != "/classify":
+            self.send_json(404, {"error": "Unknown path " + self.path})
+            return
+
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError as error:
+            self.send_json(400, {"error": "Invalid request: " + str(error)})
+            return
+
+        error = request_error(request)
+        if error is not None:
+            self.send_json(400, {"error": error})
+            return
+
+        # Pick up the classifier once so a reload can't change it part way through
+        classifier = self.server.classifier
+
+        if "documents" in request:
+            results = classifier["model"].score_batch([nltk.word_tokenize(text) for text in request["documents"]])
+            response = {"results": [{"class": class_name, "log_probability": log_probability}
+                                    for class_name, log_probability in results]}
+        else:
+            response = classify_text(classifier, request["text"], self.server.batcher)
+
+        response["latency_ms"] = (time.time() - start) * 1000.0
+        logging.debug("Classified in " + str(response["latency_ms"]) + "ms")
+
+        self.send_json(200, response)
+
+    def send_json(self, status, body):
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    # Unix socket clients don't have an address
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + " " + (format % args))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
@@ -0,0 +1,206 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# numpy gives us the per class log probabilities
+import numpy
+
+# Used for stemming
+import nltk
+
+# Pulls in stemming
+import words
+
+# The compiled model file format and scoring
+import bayes_model
+
+
+###############################################################################
+#
+# A trained Naive Bayes classifier that can be embedded in other programs.
+# It wraps the compiled model (see bayes_model) along with the stopwords it
+# was trained with and the stemmer, so callers only deal in tokens.  Once
+# built it can't be changed: attributes can't be set, the model's arrays are
+# read only and the stopwords are a frozenset.  Scoring only reads this state,
+# so one instance can be shared by any number of threads without locking.
+#
+#     model = NaiveBayesModel.load("bayes_model.bin")
+#     class_name, log_probability = model.score(nltk.word_tokenize(text))
+#
+# Stemming follows the model file unless the stemming argument says
+# otherwise.
+#
+###############################################################################
+
+class NaiveBayesModel(object):
+
+    __slots__ = ("_model", "_stopwords", "_stemmer", "_classes")
+
+    def __init__(self, model, stemming=None):
+        if stemming is None:
+            stemming = model.get("stemming", False)
+
+        # Our own copy of the model with every array made read only
+        model = dict(model)
+        for key, value in model.iteritems():
+            if isinstance(value, numpy.ndarray):
+                value = value.view()
+                value.flags.writeable = False
+                model[key] = value
+
+        object.__setattr__(self, "_model", model)
+        object.__setattr__(self, "_stopwords", frozenset(model["stopwords"]))
+        object.__setattr__(self, "_stemmer", nltk.PorterStemmer() if stemming else None)
+        object.__setattr__(self, "_classes", tuple(model["classes"]))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NaiveBayesModel is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("NaiveBayesModel is immutable")
+
+    @classmethod
+    def load(cls, file_name, stemming=None):
+        return cls(bayes_model.load_model(file_name), stemming)
+
+    # View a model in a buffer from bayes_model.share_model without copying it
+    @classmethod
+    def from_buffer(cls, buffer, stemming=None):
+        return cls(bayes_model.load_model_buffer(buffer), stemming)
+
+    # Copy the model into shared memory for processes forked after this
+    def share(self):
+        return bayes_model.share_model(self._model)
+
+    # Share a model file with processes forked after this, copying it only if it must
+    @staticmethod
+    def share_file(file_name):
+        return bayes_model.share_model_file(file_name)
+
+    def save(self, file_name):
+        bayes_model.save_model(file_name, self._model)
+
+    @property
+    def classes(self):
+        return self._classes
+
+    @property
+    def vocabulary_size(self):
+        return self._model["vocabulary_size"]
+
+    @property
+    def stemming(self):
+        return self._stemmer is not None
+
+    ###########################################################################
+    #
+    # Stem tokens the way the model was trained.  The score methods do this
+    # for you; the *_terms methods take terms that are already stemmed.
+    #
+    ###########################################################################
+
+    def stem(self, tokens):
+        if self._stemmer is None:
+            return tokens
+        return words.stem_words_array(tokens, self._stemmer)
+
+    ###########################################################################
+    #
+    # Return the most probable class of a document and its log probability.
+    #
+    ###########################################################################
+
+    def score(self, tokens):
+        return self.score_terms(self.stem(tokens))
+
+    def score_terms(self, terms):
+        return bayes_model.most_probable_class(self._model, self.class_log_probabilities(terms))
+
+    ###########################################################################
+    #
+    # Score a list of documents together.  Their term vectors are scored as a
+    # single batch, which is much cheaper per document than scoring them one
+    # at a time.  Returns a (class, log probability) pair per document.
+    #
+    ###########################################################################
+
+    def score_batch(self, list_of_tokens):
+        return self.score_batch_terms([self.stem(tokens) for tokens in list_of_tokens])
+
+    def score_batch_terms(self, list_of_terms):
+        document_vectors = [bayes_model.document_term_vector(self._model, terms, self._stopwords)
+                            for terms in list_of_terms]
+        class_probabilities = bayes_model.score_documents(self._model, document_vectors)
+        return [bayes_model.most_probable_class(self._model, document_probabilities)
+                for document_probabilities in class_probabilities]
+
+    ###########################################################################
+    #
+    # Return the k most probable classes of a document, most probable first,
+    # as (class, log probability) pairs.
+    #
+    ###########################################################################
+
+    def top_k(self, tokens, k):
+        class_probabilities = self.class_log_probabilities(self.stem(tokens))
+        order = numpy.argsort(-class_probabilities, kind="mergesort")[:k]
+        return [(self._classes[class_index], float(class_probabilities[class_index])) for class_index in order]
+
+    ###########################################################################
+    #
+    # The log probability of the document for every class, in the order of
+    # classes.
+    #
+    ###########################################################################
+
+    def class_log_probabilities(self, terms):
+        term_ids, term_counts, unknown_count = bayes_model.document_term_vector(self._model, terms, self._stopwords)
+        return bayes_model.score_document(self._model, term_ids, term_counts, unknown_count)
+
+    ###########################################################################
+    #
+    # Score a document a chunk of terms at a time, stopping once the leading
+    # class can't be overtaken (see bayes_model.score_document_early_exit).
+    # Returns the class, its log probability, how many terms were scored and
+    # how many terms the document has.
+    #
+    ###########################################################################
+
+    def score_early_exit_terms(self, terms, chunk_size):
+        term_sequence = bayes_model.document_term_sequence(self._model, terms, self._stopwords)
+        class_name, log_probability, terms_scored = bayes_model.score_document_early_exit(self._model, term_sequence, chunk_size)
+        return class_name, log_probability, terms_scored, len(term_sequence)
+
+    ###########################################################################
+    #
+    # Explain the classification of a document: the winning class, its margin
+    # over the runner up and the top_terms terms that contribute most to each
+    # class (see bayes_model.explain_document).
+    #
+    ###########################################################################
+
+    def explain(self, tokens, top_terms=10):
+        return self.explain_terms(self.stem(tokens), top_terms)
+
+    def explain_terms(self, terms, top_terms=10):
+        term_ids, term_counts, unknown_count = bayes_model.document_term_vector(self._model, terms, self._stopwords)
+        return bayes_model.explain_document(self._model, term_ids, term_counts, unknown_count, top_terms)
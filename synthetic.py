@@ -0,0 +1,302 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# argparse is a standard Python mechanism for handling commandline
+# args while avoiding a bunch of boilerplate code.
+import argparse
+
+# Directory listings, logging helpers and stage timings
+from utils import fs, log, timing
+
+# numpy draws the Zipf distributed terms
+import numpy
+
+# Training is benchmarked in its own process so we can measure its memory
+import subprocess
+
+# Used to read the peak memory of the training process
+import resource
+
+# Used to find bayes.py and the python interpreter
+import os
+import sys
+
+# Used to time training
+import time
+
+# Used to read in the unicode documents
+import codecs
+
+# Used for tokenizing
+import nltk
+
+# The classifier we are benchmarking
+from naive_bayes import NaiveBayesModel
+
+
+###############################################################################
+#
+# Generate synthetic labelled corpora that are as large as we like and run
+# training and classification benchmarks against them.  The NLTK corpora are
+# far too small to show how training memory or classification latency grow
+# with the size of the vocabulary, the number of classes or the length of
+# documents.
+#
+###############################################################################
+
+def main():
+    args = configure_command_line_arguments()
+
+    if args["generate"]:
+        generate_corpus(args)
+
+    if args["benchmark"]:
+        benchmark(args)
+
+
+###############################################################################
+#
+# Word frequencies in natural language roughly follow Zipf's law: the word
+# of rank r occurs in proportion to 1 / r^s.  Every document draws its terms
+# from two Zipf distributions over the same vocabulary.  Most terms come from
+# the distribution shared by every class.  A classShare fraction comes from
+# the class's own distribution, which is the shared one rotated so that each
+# class favors its own slice of the vocabulary.  That gives the classifier
+# something to learn without needing a separate distribution per class.
+#
+# The corpus is written as a labelled directory (one subdirectory per class)
+# that bayes.py can train on with --labelledCorpus.  Terms are written as w
+# followed by their rank, so they are never stop words.
+#
+###############################################################################
+
+def generate_corpus(args):
+    number_of_classes = int(args["classes"])
+    vocabulary_size = int(args["vocabulary"])
+    random = numpy.random.RandomState(int(args["seed"]))
+
+    cumulative_weights = numpy.cumsum(1.0 / numpy.arange(1, vocabulary_size + 1) ** float(args["exponent"]))
+    cumulative_weights /= cumulative_weights[-1]
+
+    number_of_tokens = 0
+    for class_index in range(number_of_classes):
+        class_name = "class" + str(class_index)
+        class_path = os.path.join(args["output"], class_name)
+        if not os.path.isdir(class_path):
+            os.makedirs(class_path)
+
+        class_offset = class_index * vocabulary_size // number_of_classes
+        for document_index in range(int(args["documents"])):
+            length = max(random.poisson(int(args["documentLength"])), 1)
+            ranks = numpy.searchsorted(cumulative_weights, random.random_sample(length))
+            from_class = random.random_sample(length) < float(args["classShare"])
+            ranks[from_class] = (ranks[from_class] + class_offset) % vocabulary_size
+
+            with open(os.path.join(class_path, "doc" + str(document_index) + ".txt"), "w") as document:
+                document.write(" ".join("w" + str(rank) for rank in ranks))
+            number_of_tokens += length
+
+    log.log_json({"output": args["output"],
+                  "classes": number_of_classes,
+                  "vocabulary": vocabulary_size,
+                  "documents": number_of_classes * int(args["documents"]),
+                  "tokens": number_of_tokens})
+
+
+###############################################################################
+#
+# Train a model on the corpus with bayes.py and then classify a random
+# sample of its documents.  Training runs as its own process, so we can
+# report its wall time and peak resident memory (the largest of it and its
+# worker processes).  Classification is timed per stage and per document
+# in this process.  Everything is reported as JSON lines.
+#
+###############################################################################
+
+def benchmark(args):
+    bayes_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bayes.py")
+    command = [sys.executable, bayes_script, "-t",
+               "-lc", args["output"],
+               "-m", args["model"],
+               "-w", str(args["workers"]),
+               "--shardSize", str(args["shardSize"])]
+
+    start = time.time()
+    subprocess.check_call(command)
+    training_seconds = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    log.log_json({"stage": "train",
+                  "seconds": training_seconds,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+                  "model_bytes": os.path.getsize(args["model"])})
+
+    labelled = fs.labelled_file_names(args["output"])
+    random = numpy.random.RandomState(int(args["seed"]))
+    sample = [labelled[index] for index in random.permutation(len(labelled))[:int(args["benchmarkDocuments"])]]
+
+    timings = {}
+    with timing.timed_stage(timings, "model_load"):
+        model = NaiveBayesModel.load(args["model"])
+
+    correct = 0
+    start = time.time()
+    for class_name, file_name in sample:
+        with timing.timed_stage(timings, "file_read"):
+            with codecs.open(file_name, "r", "utf-8") as document:
+                text = document.read()
+        with timing.timed_stage(timings, "tokenize"):
+            terms = nltk.word_tokenize(text)
+        with timing.timed_stage(timings, "score"):
+            predicted_class, log_probability = model.score_terms(terms)
+        if predicted_class == class_name:
+            correct += 1
+    classification_seconds = time.time() - start
+
+    for summary in timing.summarize_stage_timings(timings):
+        log.log_json(summary)
+
+    log.log_json({"stage": "classify",
+                  "documents": len(sample),
+                  "documents_per_second": len(sample) / max(classification_seconds, 1e-9),
+                  "accuracy": float(correct) / max(len(sample), 1)})
+
+
+###############################################################################
+#
+# Build the commandline parser for the script and return a map of the entered
+# options.
+#
+###############################################################################
+
+def configure_command_line_arguments():
+    parser = argparse.ArgumentParser(description='Synthetic corpora for Naive Bayes scale testing')
+
+    logging_group = parser.add_mutually_exclusive_group(required=False)
+    logging_group.add_argument("-v",
+                               "--verbose",
+                               help="Set the log level verbose.",
+                               action='store_true',
+                               required=False)
+
+    logging_group.add_argument("-vv",
+                               "--veryVerbose",
+                               help="Set the log level verbose.",
+                               action='store_true',
+                               required=False)
+
+    parser.add_argument('-g',
+                        '--generate',
+                        help="Generate a synthetic labelled corpus.",
+                        required=False,
+                        action='store_true')
+
+    parser.add_argument('-b',
+                        '--benchmark',
+                        help="Benchmark training and classification on the corpus.",
+                        required=False,
+                        action='store_true')
+
+    parser.add_argument('-o',
+                        '--output',
+                        help="Directory of the synthetic corpus.",
+                        required=True)
+
+    # The shape of the corpus
+    parser.add_argument('--classes',
+                        help="Number of classes.",
+                        required=False,
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--vocabulary',
+                        help="Number of distinct terms.",
+                        required=False,
+                        type=int,
+                        default=10000)
+
+    parser.add_argument('--documents',
+                        help="Number of documents per class.",
+                        required=False,
+                        type=int,
+                        default=100)
+
+    parser.add_argument('--documentLength',
+                        help="Mean number of terms per document.",
+                        required=False,
+                        type=int,
+                        default=200)
+
+    parser.add_argument('--exponent',
+                        help="Zipf exponent of the term distribution.",
+                        required=False,
+                        type=float,
+                        default=1.1)
+
+    parser.add_argument('--classShare',
+                        help="Fraction of terms drawn from the class's own distribution.",
+                        required=False,
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument('--seed',
+                        help="Random seed, so corpora and samples can be reproduced.",
+                        required=False,
+                        type=int,
+                        default=0)
+
+    # How the benchmark trains and classifies
+    parser.add_argument('-m',
+                        '--model',
+                        help="Model file the benchmark trains.",
+                        required=False,
+                        default="synthetic_model.bin")
+
+    parser.add_argument('-w',
+                        '--workers',
+                        help="Number of processes used for training.",
+                        required=False,
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--shardSize',
+                        help="Number of files counted together when training.",
+                        required=False,
+                        type=int,
+                        default=256)
+
+    parser.add_argument('--benchmarkDocuments',
+                        help="Number of documents classified by the benchmark.",
+                        required=False,
+                        type=int,
+                        default=1000)
+
+    args = vars(parser.parse_args())
+
+    log.set_log_level_from_args(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly, Corp
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# Keeps entries in least recently used order
+import collections
+
+# The cache can be shared by threads
+import threading
+
+# Used to persist the cache between runs
+import cPickle
+import os
+
+
+###############################################################################
+#
+# A bounded least recently used cache.  Once it holds max_size entries,
+# adding another evicts the entry that was used longest ago.  It counts hits
+# and misses, can be saved to disk and loaded back in a later run, and is
+# safe to share between threads.  A copy of the cache in a worker process can
+# hand what it learned back to the parent's cache with take_updates and
+# merge_updates.
+#
+###############################################################################
+
+class LruCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # What has changed since take_updates was last called
+        self.updated_keys = set()
+        self.taken_hits = 0
+        self.taken_misses = 0
+
+    # Returns the cached value of key, computing and caching it on a miss
+    def get(self, key, compute):
+        found, value = self.lookup(key)
+        if found:
+            return value
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    # Returns (True, value) if key is cached or (False, None) if it isn't, for
+    # callers that compute the misses somewhere else
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return True, value
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = value
+            self.updated_keys.add(key)
+            while len(self.entries) > self.max_size:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.updated_keys.discard(evicted_key)
+
+    # The entries put and the hits and misses counted since the last call
+    def take_updates(self):
+        with self.lock:
+            updates = {"entries": [(key, self.entries[key]) for key in self.updated_keys],
+                       "hits": self.hits - self.taken_hits,
+                       "misses": self.misses - self.taken_misses}
+            self.updated_keys = set()
+            self.taken_hits = self.hits
+            self.taken_misses = self.misses
+
+        return updates
+
+    # Add the updates taken from another copy of the cache to this one
+    def merge_updates(self, updates):
+        for key, value in updates["entries"]:
+            self.put(key, value)
+
+        with self.lock:
+            self.hits += updates["hits"]
+            self.misses += updates["misses"]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self.entries),
+                    "hit_rate": float(self.hits) / lookups if lookups > 0 else 0.0}
+
+    # Entries are saved least recently used first so loading keeps their order
+    def save(self, file_name):
+        with self.lock:
+            entries = self.entries.items()
+
+        temporary_file_name = file_name + ".tmp"
+        with open(temporary_file_name, "wb") as cache_file:
+            cPickle.dump(entries, cache_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_file_name, file_name)
+
+    def load(self, file_name):
+        if not os.path.exists(file_name):
+            return
+
+        with open(file_name, "rb") as cache_file:
+            entries = cPickle.load(cache_file)
+
+        for key, value in entries:
+            self.put(key, value)
@@ -22,6 +22,7 @@
 
 
 import os
+import glob
 from os import listdir
 from os.path import isfile, join, split
 
@@ -145,6 +146,43 @@ def input_file_names(args):
     return file_names_at_path(args["input"], args["recursive"] == True)
 
 
+###############################################################################
+#
+# Expand a path that names a set of files.  A directory yields the files in
+# it, a glob pattern yields the files that match and any other file is read
+# as a list of file names, one per line.
+#
+###############################################################################
+
+def expand_file_names(path, recursive):
+    if os.path.isdir(path):
+        return file_names_at_path(path, recursive)
+
+    if glob.has_magic(path):
+        return sorted(f for f in glob.glob(path) if isfile(f))
+
+    with open(path) as list_file:
+        return [line.strip() for line in list_file if len(line.strip()) > 0]
+
+
+###############################################################################
+#
+# A labelled directory has one subdirectory per class, named after the class,
+# holding that class's documents.  Returns (class name, file name) pairs.
+#
+###############################################################################
+
+def labelled_file_names(path):
+    labelled = []
+    for class_name in sorted(listdir(path)):
+        class_path = join(path, class_name)
+        if is_visible_file(class_name) and not isfile(class_path):
+            for file_name in sorted(directory_file_names(class_path, True, None)):
+                labelled.append((class_name, file_name))
+
+    return labelled
+
+
 ###############################################################################
 #
 # Simple method to open a unicode CSV file.  If column names are provided the
@@ -154,6 +192,10 @@ def input_file_names(args):
 
 def open_csv_file(name, column_names=None):
     output_file = open(name, "wb")
+    return csv_writer(output_file, column_names)
+
+
+def csv_writer(output_file, column_names=None):
     output_csv_file = csv.writer(output_file,
                                  quoting=csv.QUOTE_MINIMAL)
 
@@ -21,6 +21,7 @@
 
 
 
+import json
 import logging
 
 def set_log_level_from_args(args):
@@ -43,3 +44,17 @@ def set_log_level_from_args(args):
     else:
         logging.basicConfig(format='%(message)s')        
             
+
+
+# JSON records go through their own logger with a bare format, so they stay
+# one parseable line each whatever the verbosity of the root logger
+json_logger = logging.getLogger("json")
+json_logger.propagate = False
+json_logger.setLevel(logging.WARN)
+json_handler = logging.StreamHandler()
+json_handler.setFormatter(logging.Formatter('%(message)s'))
+json_logger.addHandler(json_handler)
+
+# Emit a record as a single line of JSON
+def log_json(record):
+    json_logger.warn(json.dumps(record, sort_keys=True))
@@ -0,0 +1,80 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly, Corp
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import contextlib
+import math
+import time
+
+
+###############################################################################
+#
+# Stage timings are a dictionary of stage name to a list of elapsed times in
+# seconds, one per time the stage ran.  Passing None instead of a dictionary
+# turns timing off.
+#
+###############################################################################
+
+@contextlib.contextmanager
+def timed_stage(timings, stage):
+    if timings is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.setdefault(stage, []).append(time.time() - start)
+
+
+def merge_stage_timings(timings, more_timings):
+    for stage, elapsed_times in more_timings.iteritems():
+        timings.setdefault(stage, []).extend(elapsed_times)
+
+    return timings
+
+
+###############################################################################
+#
+# Summarize each stage as its count along with the mean, median and 99th
+# percentile in milliseconds.
+#
+###############################################################################
+
+def summarize_stage_timings(timings):
+    summaries = []
+    for stage in sorted(timings.keys()):
+        elapsed_times = sorted(timings[stage])
+        summaries.append({"stage": stage,
+                          "count": len(elapsed_times),
+                          "mean_ms": 1000.0 * sum(elapsed_times) / len(elapsed_times),
+                          "p50_ms": 1000.0 * percentile(elapsed_times, 50),
+                          "p99_ms": 1000.0 * percentile(elapsed_times, 99)})
+
+    return summaries
+
+
+# Nearest rank percentile of an already sorted list
+def percentile(sorted_values, percent):
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
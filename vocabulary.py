@@ -0,0 +1,152 @@
+# The MIT License (MIT)
+# Copyright (c) 2015 Thoughtly
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#
+#
+# numpy holds the term ids and does the counting
+import numpy
+
+# Used to take a corpus a chunk at a time
+import itertools
+
+
+###############################################################################
+#
+# A Vocabulary interns terms: the first time it sees a term it gives the term
+# the next integer id, and it gives back the same id every time after that.
+# A corpus then becomes a numpy array of int32 ids (4 bytes per word) rather
+# than a list of Python strings, and counting terms becomes a single bincount
+# over the ids instead of a dictionary update per word.  The vocabulary is
+# shared: encode several corpora with the same Vocabulary and the same term
+# has the same id in all of them.
+#
+###############################################################################
+
+class Vocabulary(object):
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.term_ids = {}
+        for term in terms:
+            self.intern(term)
+
+    # Return the id of a term, giving it the next id if it's new
+    def intern(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term_ids[term] = term_id
+            self.terms.append(term)
+        return term_id
+
+    # Return the id of a term, or -1 if we have never seen it
+    def term_id(self, term):
+        return self.term_ids.get(term, -1)
+
+    def term(self, term_id):
+        return self.terms[term_id]
+
+    # Turn words into an array of term ids, interning any new terms
+    def encode(self, words_array):
+        intern = self.intern
+        return numpy.fromiter((intern(word) for word in words_array), dtype=numpy.int32)
+
+    def decode(self, term_ids):
+        return [self.terms[term_id] for term_id in term_ids]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+
+###############################################################################
+#
+# Load a corpus (any sequence of words) as an array of term ids.  Pass in a
+# vocabulary to share ids with other corpora.  Returns the ids and the
+# vocabulary.
+#
+###############################################################################
+
+def encode_corpus(words_array, vocabulary=None):
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+
+    return vocabulary.encode(words_array), vocabulary
+
+
+###############################################################################
+#
+# Count every term of an encoded corpus.  The count of the term with id i is
+# at index i of the result.
+#
+###############################################################################
+
+def count_terms(term_ids, vocabulary):
+    return numpy.bincount(term_ids, minlength=len(vocabulary))
+
+
+###############################################################################
+#
+# Count every term of a corpus that may be too large to hold, such as a
+# stream of words.  The words are encoded and counted chunk_size at a time,
+# so only one chunk of ids is ever kept.  Pass in a vocabulary to share ids
+# with other corpora.  Returns the counts, indexed by term id, and the
+# vocabulary.
+#
+###############################################################################
+
+def count_corpus(words_array, vocabulary=None, chunk_size=1000000):
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+
+    term_counts = numpy.zeros(len(vocabulary), dtype=numpy.int64)
+    words_iterator = iter(words_array)
+    while True:
+        term_ids = vocabulary.encode(itertools.islice(words_iterator, chunk_size))
+        if len(term_ids) == 0:
+            break
+        chunk_counts = numpy.bincount(term_ids, minlength=len(vocabulary)).astype(numpy.int64)
+        chunk_counts[:len(term_counts)] += term_counts
+        term_counts = chunk_counts
+
+    return term_counts, vocabulary
+
+
+###############################################################################
+#
+# How many terms occur once, how many occur twice and so on.  Returns a
+# dictionary of frequency to the number of terms with that frequency.
+#
+###############################################################################
+
+def frequency_frequencies(term_counts):
+    frequencies, number_of_terms = numpy.unique(term_counts[term_counts > 0], return_counts=True)
+    return dict(zip(frequencies.tolist(), number_of_terms.tolist()))
+
+
+# A term: count dictionary from term counts
+def term_count_dictionary(term_counts, vocabulary):
+    return dict((vocabulary.term(term_id), int(count)) for term_id, count in enumerate(term_counts) if count > 0)
@@ -44,75 +44,125 @@ import logging
 # A simple helper for setting up log files based on commandline args
 from utils import log
 
-# Used for log method
-import math
-
 # numpy is just used for some simple array helpers
 import numpy
 
+# Used to read in unicode files
+import codecs
+
+# Remembers the stem or lemma of every word we've already normalized
+from utils import cache
+
+# Used to stem and lemmatize large corpora in parallel
+import multiprocessing
+import itertools
+
+# Counts terms straight into a dictionary
+import collections
+
+# Turns terms into integer ids so counting is vectorized
+import vocabulary
+
+# Used to key and store the corpus cache
+import hashlib
+import json
+import os
+
+
+# The most (normalizer, word) pairs kept in the normalization cache
+NORMALIZATION_CACHE_SIZE = 200000
+
+normalization_cache = cache.LruCache(NORMALIZATION_CACHE_SIZE)
+
+# Number of words each worker normalizes at a time when normalizing in parallel
+PARALLEL_CHUNK_SIZE = 50000
+
+# Bumped whenever the layout of cached corpora changes
+CORPUS_CACHE_VERSION = 1
+
+
+
 def main():
 
     # Build the commandline parser and return entered args.  This also
     # setups up any non-ML/NLP config needed by the script (such as logging)
     args = configure_command_line_arguments()
 
-    # Read text into an array of words based on what source the user entered.
-    words_array, corpus_name = load_text_corpus(args)
-
-    # Stem the input.  Stemming will take variations on a word (run, runs) and map
-    # them to a single representation of the word (run).  It loses information,
-    # but this allows subsequent analysis to be performed on the corpus under
-    # the assumption that the information contained in the precise word chosen
-    # is less valuable than that in the stem of that word.  Stemming is a
-    # relatively naive algorithm which essentially cuts off the ends of words
-    # to get them down to their base stem
-    if args["stem"]:
-        words_array = stem_words_array(words_array)
-
-    # Lemmatization serves a similar purpose as stemming.  Instead of simply
-    # cutting ends off of words, lemmatization attempts to map a word to its
-    # lemma.  This does include chopping the end off of a word in some cases.
-    # In others it is a more complex operation.  For example, lemmatization
-    # will try to map am, is, are and were to their lemma, be.  This requires
-    # a better concept of the language being lemmatized and is more resource
-    # intensive than stemming.  Different information is lost in lemmatization,
-    # so different usecases may prefer one over the other.
-    elif args["lemma"]:
-        words_array = lemmatize_words_array(words_array)
-
-    # Here we want to run through all of the corpora and calculate the uniqque
-    #  word counts, stemmed word counts and lemmatized word counts.
-    elif args["stemVsLemma"]:
-        compare_stemming_to_lemmatization()
-
-    logging.info("The corpus contains " + str(len(words_array)) + " elements after processing");
-
-    # Multiple methods make use of the unique vocabulary within the document.  We pass
-    # it into the various methods that can use it.  If it's not provided the relevant
-    # methods will calculate it.  Same applies to term frequencies
-    unique_vocabulary = None
-    term_frequencies = None
+    # Stems and lemmas from previous runs
+    if args["normalizationCache"]:
+        load_normalization_cache(args["normalizationCache"])
+
+    # A corpus cache lets us skip reading, tokenizing and normalizing the corpus
+    # entirely when it hasn't changed since it was cached.
+    normalizer = "stem" if args["stem"] else "lemma" if args["lemma"] else None
+    if args["corpusCache"] and not args["stemVsLemma"]:
+        term_ids, corpus_vocabulary, corpus_name = load_cached_text_corpus(args, args["corpusCache"], normalizer, args["workers"])
+
+        # Count every term with one bincount.  The counts are passed into the various
+        # methods that use them.
+        term_counts = vocabulary.count_terms(term_ids, corpus_vocabulary)
+        logging.info("The corpus contains " + str(len(term_ids)) + " elements after processing");
+
+    else:
+        # Read text as a stream of words based on what source the user entered.  A
+        # custom corpus is read a few docs at a time rather than all at once.
+        words_array, corpus_name = stream_text_corpus(args, args["workers"])
+
+        # Stem the input.  Stemming will take variations on a word (run, runs) and map
+        # them to a single representation of the word (run).  It loses information,
+        # but this allows subsequent analysis to be performed on the corpus under
+        # the assumption that the information contained in the precise word chosen
+        # is less valuable than that in the stem of that word.  Stemming is a
+        # relatively naive algorithm which essentially cuts off the ends of words
+        # to get them down to their base stem
+        if args["stem"]:
+            words_array = iterate_normalized_words(words_array, "stem", args["workers"])
+
+        # Lemmatization serves a similar purpose as stemming.  Instead of simply
+        # cutting ends off of words, lemmatization attempts to map a word to its
+        # lemma.  This does include chopping the end off of a word in some cases.
+        # In others it is a more complex operation.  For example, lemmatization
+        # will try to map am, is, are and were to their lemma, be.  This requires
+        # a better concept of the language being lemmatized and is more resource
+        # intensive than stemming.  Different information is lost in lemmatization,
+        # so different usecases may prefer one over the other.
+        elif args["lemma"]:
+            words_array = iterate_normalized_words(words_array, "lemma", args["workers"])
+
+        # Here we want to run through all of the corpora and calculate the uniqque
+        #  word counts, stemmed word counts and lemmatized word counts.
+        elif args["stemVsLemma"]:
+            compare_stemming_to_lemmatization(args["workers"])
+
+        # Multiple methods make use of the unique vocabulary within the document and the
+        # frequency of each term.  We count the terms as the words stream past, which
+        # gives us the vocabulary as well, so the corpus itself is never held in memory.
+        term_counts, corpus_vocabulary = vocabulary.count_corpus(words_array)
+        logging.info("The corpus contains " + str(int(term_counts.sum())) + " elements after processing");
+
+    if args["normalizationCache"]:
+        save_normalization_cache(args["normalizationCache"])
 
     # Calculating the vocabulary size gives you an idea of the overall complexity of a corpus.  It is a quick
     # and easy way to succinctly summarize a corpus down to a single number.  Generally speaking, this doesn't
     # provide a whole lot of information, but it can be a quick way to compare 2 different corpora. It can also
     # quickly illustrate the difference between an original corpus, its stemmed version and its lemmatized version.
     if args["vocabularySize"]:
-        unique_vocabulary = calculate_corpus_vocabulary_size(words_array)
+        calculate_corpus_vocabulary_size(corpus_vocabulary)
 
     # Term presence allows the user to see a list of all unique tokens in a document.  This allows the user to
     # quickly see what sorts of words appear in a corpus.  It it also useful for examining the effect of
     # tokenization or lemmatization on a corpus.  For some applications it is preferred to use the simple presence
     # of a token as compared to its frequency.
     if args["termPresence"]:
-        output_corpus_terms(words_array, unique_vocabulary)
+        output_corpus_terms(corpus_vocabulary)
 
     # Term frequency is a common method of translating a corpus into a word vector.  This method executes a simple
     # count of all instances of each term.  A term that appears 10 times in a corpus will be counted exactly 10 times.
     # Many applications need this raw term frequency to generate simple models of a language.  Other applications
     # make use of the term frequency indirectly as part of a process of vectorizing text.
     if args["termFrequency"]:
-        term_frequencies = collect_and_output_corpus_term_frequencies(words_array, corpus_name)
+        collect_and_output_corpus_term_frequencies(corpus_vocabulary, term_counts, corpus_name)
 
     # Log normalizing term frequencies effectively squashes the output counts of the term frequency process by taking
     # the log of the frequencies of each term.  If a term T appears 10 times more often than some other term X, the log
@@ -120,7 +170,7 @@ def main():
     # but words that are more frequent shouldn't be considered to be linearly more (or less) important than those
     # which are less.
     if args["logNormalize"]:
-        term_frequencies = collect_and_output_normalized_corpus_term_frequencies(words_array, corpus_name, term_frequencies)
+        collect_and_output_normalized_corpus_term_frequencies(corpus_vocabulary, term_counts, corpus_name)
 
     # Frequency frequency is a bit of an odd metric.  Here we want to know, for example, how many words are used just
     # one time?  How many are used 10?  We calculate all the frequencies of each word, just like when calculating
@@ -133,7 +183,7 @@ def main():
     # extremely frequently (the, and, a, or...).  Removing those words from this analysis can yield a bit more
     # useful information than leaving them in.
     if args["frequencyFrequency"]:
-        collect_and_output_frequency_frequencies(words_array, corpus_name, term_frequencies)
+        collect_and_output_frequency_frequencies(term_counts, corpus_name)
 
 
 
@@ -142,32 +192,29 @@ def main():
 # Calculating the vocabulary size requires only two simple steps:
 #   1) Accumulate all unique words
 #   2) Count the unique words accumulated in 1
+# The Vocabulary built when the corpus was encoded already did step 1 (see
+# vocabulary.py), so all that is left is to count.
 #
 ################################################################################
 
-def calculate_corpus_vocabulary_size(corpus):
-    unique_vocabulary = collect_unique_terms(corpus)
-    logging.debug("The corpus has a total vocabulary of " + str(len(unique_vocabulary))
+def calculate_corpus_vocabulary_size(corpus_vocabulary):
+    logging.debug("The corpus has a total vocabulary of " + str(len(corpus_vocabulary))
                     + " unique tokens.")
-    return unique_vocabulary
+    return len(corpus_vocabulary)
 
 
 
 ###############################################################################
 #
-# This method takes or determines the unique_vocabulary for the given corpus.
-# This is then output to a CSV file where each row is a single term from the
-# corpus.
+# This method takes the vocabulary of the given corpus and outputs it to a
+# CSV file where each row is a single term from the corpus.
 #
 ###############################################################################
 
-def output_corpus_terms(corpus, unique_vocabulary=None):
-    if unique_vocabulary is None:
-        unique_vocabulary = collect_unique_terms(corpus)
-
+def output_corpus_terms(corpus_vocabulary):
     output_csv_file = fs.open_csv_file("corpus_terms.csv", ["Term"])
 
-    for term in unique_vocabulary:
+    for term in corpus_vocabulary:
         logging.debug(term)
         output_csv_file.writerow([term])
 
@@ -175,18 +222,16 @@ def output_corpus_terms(corpus, unique_vocabulary=None):
 
 ###############################################################################
 #
-# This method goes through a corpus of text and outputs the raw frequency
-# counts of each unique term.
+# This method takes the raw frequency counts of each unique term in a corpus
+# (indexed by term id) and outputs them, most frequent first.
 #
 ###############################################################################
 
-def collect_and_output_corpus_term_frequencies(corpus, corpus_name):
-    term_frequencies = collect_term_counts(corpus)
-
+def collect_and_output_corpus_term_frequencies(corpus_vocabulary, term_counts, corpus_name):
     output_csv_file = fs.open_csv_file("term_frequencies.csv", ["Term", "Frequency"])
 
-    unsorted_array = [[key,value] for key, value in term_frequencies.iteritems()]
-    sorted_array = sorted(unsorted_array, key=lambda term_frequency: term_frequency[1], reverse=True)
+    order = numpy.argsort(-term_counts, kind="mergesort")
+    sorted_array = [[corpus_vocabulary.term(term_id), int(term_counts[term_id])] for term_id in order]
 
     for term, frequency in sorted_array:
         output_csv_file.writerow([term] + [frequency])
@@ -197,36 +242,30 @@ def collect_and_output_corpus_term_frequencies(corpus, corpus_name):
                            "Term Frequencies",
                            sorted_array, [0, 1, 2, -3, -2, -1])
 
-    return term_frequencies
+    return term_counts
 
 
 
 ###############################################################################
 #
-# This method takes in or generates term frequencies.  Each unique term in the
-# corpus is counted.  This first step is identical to the process in
-# collect_and_output_corpus_term_frequencies.  Once those words are collected,
-# the method iterates through each term/count pair and log normalizes the
-# count where normalized = 1 + log10(frequency).  This will result in a value
-# of 1 if frequency is 1, 2 if frequency is 10, 3 if frequency is 100, etc.
+# This method takes the term frequencies of a corpus, the same ones
+# collect_and_output_corpus_term_frequencies outputs, and log normalizes every
+# count at once where normalized = 1 + log10(frequency).  This will result in
+# a value of 1 if frequency is 1, 2 if frequency is 10, 3 if frequency is
+# 100, etc.
 #
 ###############################################################################
 
-def collect_and_output_normalized_corpus_term_frequencies(corpus, corpus_name, term_frequencies=None):
-
-    if term_frequencies is None:
-        term_frequencies = collect_term_counts(corpus)
-
+def collect_and_output_normalized_corpus_term_frequencies(corpus_vocabulary, term_counts, corpus_name):
     output_csv_file = fs.open_csv_file("normalized_term_frequencies.csv", ["Term", "Log Normalized TF"])
 
-    unsorted_array = []
+    normalized_term_frequencies = 1 + numpy.log10(term_counts)
 
-    for term, frequency in term_frequencies.iteritems():
-        normalized_term_frequency = (1 + math.log(frequency, 10))
-        unsorted_array.append([term, normalized_term_frequency])
+    for term, normalized_term_frequency in zip(corpus_vocabulary, normalized_term_frequencies.tolist()):
         output_csv_file.writerow([term] + [normalized_term_frequency])
 
-    sorted_array = sorted(unsorted_array, key=lambda term_frequency: term_frequency[1], reverse=True)
+    order = numpy.argsort(-normalized_term_frequencies, kind="mergesort")
+    sorted_array = [[corpus_vocabulary.term(term_id), float(normalized_term_frequencies[term_id])] for term_id in order]
 
     # output a bar chart illustrating the above
     chart_term_frequencies("normalized_term_frequencies.png",
@@ -234,7 +273,7 @@ def collect_and_output_normalized_corpus_term_frequencies(corpus, corpus_name, t
                            "Term Frequencies",
                            sorted_array, [0, 1, 2, -3, -2, -1])
 
-    return term_frequencies
+    return normalized_term_frequencies
 
 
 
@@ -246,20 +285,13 @@ def collect_and_output_normalized_corpus_term_frequencies(corpus, corpus_name, t
 # to calculate the number of terms that are used a given number of times.  For
 # example, this method would identify the number of terms that appear once in
 # a document.  It will also identify the number of terms that appear 10 times
-# in a document, etc.
+# in a document, etc.  With the counts in an array this is itself just a count
+# of the distinct counts (see vocabulary.frequency_frequencies).
 #
 ###############################################################################
 
-def collect_and_output_frequency_frequencies(corpus, corpus_name, term_frequencies):
-    if term_frequencies is None:
-        term_frequencies = collect_term_counts(corpus)
-
-    frequency_frequencies = {}
-    for term, frequency in term_frequencies.iteritems():
-        if frequency_frequencies.has_key(frequency):
-            frequency_frequencies[frequency] += 1
-        else:
-            frequency_frequencies[frequency] = 1
+def collect_and_output_frequency_frequencies(term_counts, corpus_name):
+    frequency_frequencies = vocabulary.frequency_frequencies(term_counts)
 
     unsorted_array = [[key,value] for key, value in frequency_frequencies.iteritems()]
     sorted_array = sorted(unsorted_array, key=lambda frequency_frequency: frequency_frequency[1], reverse=True)
@@ -294,116 +326,325 @@ def collect_and_output_frequency_frequencies(corpus, corpus_name, term_frequenci
 
 ###############################################################################
 #
-# We use a Python dictionary to accomplish this.  Because we are simply
-# checking for the existence of a word, it is sufficient to simply add it to
-# a dictionary with a value of 1 (really any value would suffice).  Because a
-# dictionary will not allow duplicate keys, we can be sure that the accumulated
-# words in the dictionary are unique.
+# This method iterates through the entire corpus and collects counts of all
+# unique words as a term: count dictionary.  Each instance of a term
+# increments a counter tied to the value of the term.  When all we want is
+# the dictionary, counting into it directly is faster than encoding the
+# corpus into term ids first, since that costs a dictionary lookup per word
+# anyway.
 #
 ################################################################################
 
-def collect_unique_terms(corpus):
-    unique_vocabulary = {}
+def collect_term_counts(corpus):
+    term_counts = collections.defaultdict(int)
     for term in corpus:
-        unique_vocabulary[term] = 1;
+        term_counts[term] += 1
 
-    return unique_vocabulary;
+    return dict(term_counts)
 
 
 
 ###############################################################################
 #
-# This method iterates through the entire corpus and collects counts of all
-# unique words.
-#
-# Similar to collect_unique_words, this method uses a dictionary to track the
-# uniqueness of a word.  Unlike collect_unique_words, this method does not
-# simply note the existence of a new word.  Instead, each instance of a term
-# increments a counter tied to the value of the term.
+# Most of this method simply returns the relevant corpus based on the requested
+# corpus name passed in via the commandline.  The last option, custom, is used
+# when the user chooses to look at a corpus comprised of one or more of their
+# own documents.
 #
-################################################################################
+###############################################################################
 
-def collect_term_counts(corpus):
-    unique_word_counts = {}
-    for term in corpus:
-        if unique_word_counts.has_key(term):
-            unique_word_counts[term] += 1;
-        else:
-            unique_word_counts[term] = 1
+def load_text_corpus(args):
 
-    return unique_word_counts
+    corpus, name = select_text_corpus(args)
+
+    if corpus is not None:
+        words = corpus.words()
+
+    elif name == "Custom":
+        logging.debug("Loading a custom corpus from " + args["custom"])
+        words = load_custom_corpus(args["custom"])
+    else:
+        words = ""
+
+    if len(words) > 0:
+        logging.debug("Read " + str(len(words)) + " words: " + str(words[0:20]))
+
+    return words, name
+
+
+# Like load_text_corpus, but a custom corpus comes back as a lazy stream of
+# words (see iterate_custom_corpus) rather than a list
+def stream_text_corpus(args, workers=1):
+
+    corpus, name = select_text_corpus(args)
+
+    if corpus is not None:
+        return corpus.words(), name
+
+    elif name == "Custom":
+        logging.debug("Streaming a custom corpus from " + args["custom"])
+        return iterate_custom_corpus(args["custom"], workers=workers), name
+
+    return [], name
 
 
 
 ###############################################################################
 #
-# Most of this method simply returns the relevant corpus based on the requested
-# corpus name passed in via the commandline.  The last option, custom, is used
-# when the user chooses to look at a corpus comprised of one or more of their
-# own documents.
+# Pick the NLTK corpus reader and name for the corpus requested on the
+# commandline.  A custom corpus has no reader, just the name "Custom".
 #
 ###############################################################################
 
-def load_text_corpus(args):
+def select_text_corpus(args):
 
     if args.has_key("abc") and args["abc"]:
         logging.debug("Loading the ABC corpus.")
-        name = "ABC"
-        words = nltk.corpus.abc.words()
+        return nltk.corpus.abc, "ABC"
 
     elif args.has_key("genesis") and args["genesis"]:
         logging.debug("Loading the Genesis corpus.")
-        name = "Genesis"
-        words = nltk.corpus.genesis.words()
+        return nltk.corpus.genesis, "Genesis"
 
     elif args.has_key("gutenberg") and args["gutenberg"]:
         logging.debug("Loading the Gutenberg corpus.")
-        name = "Gutenberg"
-        words = nltk.corpus.gutenberg.words()
+        return nltk.corpus.gutenberg, "Gutenberg"
 
     elif args.has_key("inaugural") and args["inaugural"]:
         logging.debug("Loading the Inaugural Address corpus.")
-        name = "Inaugural"
-        words = nltk.corpus.inaugural.words()
+        return nltk.corpus.inaugural, "Inaugural"
 
     elif args.has_key("stateUnion") and args["stateUnion"]:
         logging.debug("Loading the State of the Union corpus.")
-        name = "Union"
-        words = nltk.corpus.state_union.words()
+        return nltk.corpus.state_union, "Union"
 
     elif args.has_key("webtext") and args["webtext"]:
         logging.debug("Loading the webtext corpus.")
-        name = "Web"
-        words = nltk.corpus.webtext.words()
+        return nltk.corpus.webtext, "Web"
 
     elif args.has_key("custom") and args["custom"] != None:
-        logging.debug("Loading a custom corpus from " + args["custom"])
-        name = "Custom"
-        words = load_custom_corpus(args["custom"])
+        return None, "Custom"
+
+    return None, "None"
+
+
+
+###############################################################################
+#
+# Some uses (cross validation, for example) need a corpus split into its
+# individual documents.  For the NLTK corpora a document is one of the
+# corpus's fileids and for a custom corpus it's one of the files in the
+# directory.  text_corpus_document_ids lists the documents and
+# load_text_corpus_document reads the words of a single one.
+#
+###############################################################################
+
+def text_corpus_document_ids(args):
+
+    corpus, name = select_text_corpus(args)
+
+    if corpus is not None:
+        document_ids = corpus.fileids()
+    elif name == "Custom":
+        document_ids = sorted(fs.directory_file_names(args["custom"], True, None))
     else:
-        words = ""
-        name = "None"
+        document_ids = []
 
-    if len(words) > 0:
-        logging.debug("Read " + str(len(words)) + " words: " + str(words[0:20]))
+    return document_ids, name
+
+
+def load_text_corpus_document(args, document_id):
+
+    corpus, name = select_text_corpus(args)
+
+    if corpus is not None:
+        return corpus.words(document_id)
+
+    return load_document_file(document_id)
 
-    return words, name
+
+# Read and tokenize a single utf-8 document
+def load_document_file(file_name):
+    with codecs.open(file_name, "r", "utf-8") as document:
+        return nltk.word_tokenize(document.read())
 
 
 
 ###############################################################################
 #
-# Combine all the docs into a single string and then tokenize.
+# Reading a corpus through its NLTK reader (or tokenizing a custom corpus)
+# and then stemming or lemmatizing it is slow, and we repeat it on every run.
+# The corpus cache keeps the result in a cache directory instead: the
+# vocabulary as a JSON list of terms and the corpus itself as an array of
+# int32 term ids (see vocabulary.py), saved with numpy so later runs can
+# memory map it rather than read it.  A cached corpus is found by a key made
+# from the corpus name, the path, size and modification time of every file in
+# it, and the normalizer ("stem", "lemma" or None), so changing any of them
+# gives a new key rather than a stale corpus.
 #
-###############################################################################    
+# load_cached_document_files does the same for a list of document files, such
+# as one shard of a training corpus, keyed by the files alone.
+#
+# Both return the term ids and the vocabulary; load_cached_text_corpus
+# returns the corpus name as well.
+#
+###############################################################################
+
+def load_cached_text_corpus(args, cache_directory, normalizer=None, workers=1):
+    corpus, name = select_text_corpus(args)
+
+    def load_words():
+        words_array, corpus_name = stream_text_corpus(args, workers)
+        return words_array
+
+    term_ids, corpus_vocabulary = load_cached_corpus(name, text_corpus_source_files(args), cache_directory,
+                                                     normalizer, workers, load_words)
+    return term_ids, corpus_vocabulary, name
+
+
+def load_cached_document_files(file_names, cache_directory, normalizer=None):
+
+    def load_words():
+        for file_name, tokens in iterate_document_files(file_names):
+            for token in tokens:
+                yield token
+
+    return load_cached_corpus("Documents", file_names, cache_directory, normalizer, 1, load_words)
+
+
+def load_cached_corpus(name, source_files, cache_directory, normalizer, workers, load_words):
+    key_source = {"version": CORPUS_CACHE_VERSION,
+                  "corpus": name,
+                  "normalizer": normalizer,
+                  "files": [[file_name, os.path.getsize(file_name), os.path.getmtime(file_name)]
+                            for file_name in source_files]}
+    key = hashlib.sha1(json.dumps(key_source, sort_keys=True)).hexdigest()
+    ids_file_name = os.path.join(cache_directory, key + ".ids.npy")
+    terms_file_name = os.path.join(cache_directory, key + ".terms.json")
+
+    if os.path.exists(ids_file_name) and os.path.exists(terms_file_name):
+        logging.debug("Loading " + name + " from the corpus cache " + ids_file_name)
+        with codecs.open(terms_file_name, "r", "utf-8") as terms_file:
+            corpus_vocabulary = vocabulary.Vocabulary(json.load(terms_file))
+        return numpy.load(ids_file_name, mmap_mode="r"), corpus_vocabulary
+
+    words_array = load_words()
+    if normalizer is not None:
+        words_array = iterate_normalized_words(words_array, normalizer, workers)
+    term_ids, corpus_vocabulary = vocabulary.encode_corpus(words_array)
+
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+
+    # The terms are written last, so a half written cache entry is never used
+    with open(ids_file_name + ".tmp", "wb") as ids_file:
+        numpy.save(ids_file, term_ids)
+    os.rename(ids_file_name + ".tmp", ids_file_name)
+    with codecs.open(terms_file_name + ".tmp", "w", "utf-8") as terms_file:
+        json.dump(corpus_vocabulary.terms, terms_file, ensure_ascii=False)
+    os.rename(terms_file_name + ".tmp", terms_file_name)
+
+    logging.debug("Cached " + name + " in " + ids_file_name)
+
+    return term_ids, corpus_vocabulary
+
+
+###############################################################################
+#
+# The files a corpus is read from.  NLTK corpora can be plain files or live
+# inside a zip file, in which case the zip file is the source.
+#
+###############################################################################
+
+def text_corpus_source_files(args):
+    corpus, name = select_text_corpus(args)
+
+    if corpus is not None:
+        source_files = set()
+        for fileid in corpus.fileids():
+            path_pointer = corpus.abspath(fileid)
+            if hasattr(path_pointer, "zipfile"):
+                source_files.add(path_pointer.zipfile.filename)
+            else:
+                source_files.add(path_pointer.path)
+        return sorted(source_files)
+
+    if name == "Custom":
+        return sorted(fs.directory_file_names(args["custom"], True, None))
+
+    return []
+
+
+
+###############################################################################
+#
+# Read every doc in a custom corpus and return all of their tokens as one
+# list.  Each doc is tokenized on its own (see iterate_custom_corpus).
+#
+###############################################################################
 
 def load_custom_corpus(path):
-    all_custom_files = fs.directory_file_names(path, True, None)
-    combined_corpus = ""
-    for file_name in all_custom_files:
-        combined_corpus = open(file_name).read() + "\n";
+    return list(iterate_custom_corpus(path))
+
+
+
+###############################################################################
+#
+# A custom corpus can be much larger than memory, so rather than reading it
+# all at once we walk its files lazily and tokenize them one at a time.
+# iterate_custom_corpus yields every token of every doc in turn, or, with
+# per_document set, one list of tokens per doc.  Only the docs currently
+# being tokenized are ever held in memory, so counting terms as they stream
+# past (with vocabulary.count_corpus, as words.py does) only needs room for
+# the vocabulary and the counts.
+#
+# With more than one worker the docs are tokenized by a process pool, a
+# window of a few docs per worker at a time so the working set stays bounded,
+# and still come back in order.  Docs that can't be read or decoded are
+# skipped with a warning.
+#
+###############################################################################
 
-    return nltk.word_tokenize(combined_corpus)
+def iterate_custom_corpus(path, per_document=False, workers=1):
+    file_names = sorted(fs.directory_file_names(path, True, None))
+
+    for file_name, tokens in iterate_document_files(file_names, workers):
+        if per_document:
+            yield tokens
+        else:
+            for token in tokens:
+                yield token
+
+
+# Yields (file name, tokens) for each readable doc, in order
+def iterate_document_files(file_names, workers=1):
+    if workers <= 1:
+        for file_name in file_names:
+            tokens = load_document_file_or_skip(file_name)
+            if tokens is not None:
+                yield file_name, tokens
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        window = workers * 4
+        for start in range(0, len(file_names), window):
+            window_file_names = file_names[start:start + window]
+            for file_name, tokens in itertools.izip(window_file_names, pool.imap(load_document_file_or_skip, window_file_names)):
+                if tokens is not None:
+                    yield file_name, tokens
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_document_file_or_skip(file_name):
+    try:
+        return load_document_file(file_name)
+    except (IOError, UnicodeDecodeError) as error:
+        logging.warn("Skipping " + file_name + ": " + str(error))
+        return None
 
 
 
@@ -413,21 +654,16 @@ def load_custom_corpus(path):
 # stemmed version.  Stemming serves to map multiple words with the same root
 # down to a single word stem.  This allows for a reduction in features.  Also,
 # in some applications, it is more useful to consider words by their stems
-# rather than consider the actual word.
+# rather than consider the actual word.  A long running caller can pass in
+# its own stemmer so it isn't rebuilt on every call.
 #
 ################################################################################
 
-def stem_words_array(words_array):
-    stemmer = nltk.PorterStemmer();
-    stemmed_words_array = [];
-    for word in words_array:
-        try:
-            stem = stemmer.stem(word);
-            stemmed_words_array.append(stem);
-        except Exception:
-            pass
+def stem_words_array(words_array, stemmer=None):
+    if stemmer is None:
+        stemmer = nltk.PorterStemmer();
 
-    return stemmed_words_array;
+    return normalize_words_array(words_array, "stem:" + type(stemmer).__name__, stemmer.stem, True)
 
 
 
@@ -435,17 +671,230 @@ def stem_words_array(words_array):
 #
 # Lemmatization is implemented similarly to stemming.  We iterate over each
 # word in the input array and lemmatize it using the NLTK WordNetLemmatizer.
+# As with stemming, a caller can pass in its own lemmatizer.
+#
+################################################################################
+
+def lemmatize_words_array(words_array, lemmatizer=None):
+    if lemmatizer is None:
+        lemmatizer = nltk.stem.WordNetLemmatizer()
+
+    return normalize_words_array(words_array, "lemma:" + type(lemmatizer).__name__, lemmatizer.lemmatize)
+
+
+
+################################################################################
+#
+# A corpus is made up of far fewer distinct words than words, and the same
+# few thousand words make up most of any corpus, so we only stem or
+# lemmatize each distinct word once.  Results are kept in
+# normalization_cache, keyed by the normalizer and the word, so they carry
+# over between calls (and, if the cache is saved with
+# save_normalization_cache, between runs).  If skip_errors is set, words the
+# normalizer can't handle are dropped.
+#
+################################################################################
+
+def normalize_words_array(words_array, normalizer_name, normalize, skip_errors=False):
+    normalized_words = {}
+    for word in set(words_array):
+        normalized_words[word] = normalization_cache.get((normalizer_name, word),
+                                                         lambda: normalize_word(normalize, word, skip_errors))
+
+    return [normalized_words[word] for word in words_array if normalized_words[word] is not None]
+
+
+def normalize_word(normalize, word, skip_errors):
+    if not skip_errors:
+        return normalize(word)
+
+    try:
+        return normalize(word)
+    except Exception:
+        return None
+
+
+
+################################################################################
+#
+# Stem ("stem") or lemmatize ("lemma") a large corpus with a pool of worker
+# processes.  The words are split into chunks of chunk_size words, each
+# worker builds its own stemmer or lemmatizer once and normalizes whole
+# chunks, and the chunks are put back together in their original order.
+# With a single worker this is just stem_words_array or
+# lemmatize_words_array.
+#
+# The normalization cache stays in the parent.  Each chunk's distinct words
+# are looked up there first and only the words it doesn't have yet are sent
+# to the workers; what they send back goes into the cache.  That way the
+# parallel path fills the same cache, and reports the same hits and misses,
+# as the serial one, and a saved cache is used on the next run.  Chunks are
+# handed to the pool a window of a few per worker at a time, so a stream of
+# words is never read far ahead of the chunks being normalized.
+#
+# stream_normalize_words_array does the same but yields each normalized
+# chunk as soon as it is ready, so the caller can start on the first chunks
+# while the rest are still being normalized.  Chunks are yielded in order
+# unless ordered is False, in which case they come in the order they finish
+# along with the index of the chunk.
+#
+################################################################################
+
+def parallel_normalize_words_array(words_array, normalizer, workers, chunk_size=PARALLEL_CHUNK_SIZE):
+    if workers <= 1:
+        return NORMALIZERS[normalizer](words_array)
+
+    normalized_words = []
+    for chunk in stream_normalize_words_array(words_array, normalizer, workers, chunk_size):
+        normalized_words.extend(chunk)
+
+    return normalized_words
+
+
+def stream_normalize_words_array(words_array, normalizer, workers, chunk_size=PARALLEL_CHUNK_SIZE, ordered=True):
+    cache_name = NORMALIZER_CACHE_NAMES[normalizer]
+    indexed_chunks = itertools.izip(itertools.count(), word_chunks(words_array, chunk_size))
+
+    pool = multiprocessing.Pool(max(workers, 1), initializer=start_normalization_worker, initargs=(normalizer,))
+    try:
+        window = max(workers, 1) * 4
+        while True:
+            chunks = dict(itertools.islice(indexed_chunks, window))
+            if len(chunks) == 0:
+                break
+
+            normalized_words = {}
+            missed_words = []
+            for chunk_index in sorted(chunks):
+                normalized_words[chunk_index], chunk_missed_words = cached_normalized_words(chunks[chunk_index], cache_name)
+                missed_words.append((chunk_index, chunk_missed_words))
+
+            if ordered:
+                results = pool.imap(normalize_words, missed_words)
+            else:
+                results = pool.imap_unordered(normalize_words, missed_words)
+
+            for chunk_index, normalized_pairs in results:
+                chunk_normalized_words = normalized_words.pop(chunk_index)
+                for word, normalized_word in normalized_pairs:
+                    normalization_cache.put((cache_name, word), normalized_word)
+                    chunk_normalized_words[word] = normalized_word
+
+                normalized_chunk = [chunk_normalized_words[word] for word in chunks.pop(chunk_index)
+                                    if chunk_normalized_words[word] is not None]
+                if ordered:
+                    yield normalized_chunk
+                else:
+                    yield chunk_index, normalized_chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Look up the distinct words of a chunk in the normalization cache.  Returns
+# a word: normalized word dictionary of the hits and a list of the misses.
+def cached_normalized_words(chunk, cache_name):
+    normalized_words = {}
+    missed_words = []
+    for word in set(chunk):
+        found, normalized_word = normalization_cache.lookup((cache_name, word))
+        if found:
+            normalized_words[word] = normalized_word
+        else:
+            missed_words.append(word)
+
+    return normalized_words, missed_words
+
+
+# Stem or lemmatize a stream of words a chunk at a time, yielding the
+# normalized words in order without ever holding the whole stream
+def iterate_normalized_words(words_array, normalizer, workers, chunk_size=PARALLEL_CHUNK_SIZE):
+    if workers <= 1:
+        chunks = itertools.imap(NORMALIZERS[normalizer], word_chunks(words_array, chunk_size))
+    else:
+        chunks = stream_normalize_words_array(words_array, normalizer, workers, chunk_size)
+
+    for chunk in chunks:
+        for word in chunk:
+            yield word
+
+
+def word_chunks(words_array, chunk_size):
+    words_iterator = iter(words_array)
+    while True:
+        chunk = list(itertools.islice(words_iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+# The normalizers parallel_normalize_words_array knows about
+NORMALIZERS = {"stem": stem_words_array,
+               "lemma": lemmatize_words_array}
+
+# The normalizer part of their normalization cache keys, the same as
+# stem_words_array and lemmatize_words_array use
+NORMALIZER_CACHE_NAMES = {"stem": "stem:" + nltk.PorterStemmer.__name__,
+                          "lemma": "lemma:" + nltk.stem.WordNetLemmatizer.__name__}
+
+# Each worker process keeps its own stemmer or lemmatizer here
+normalization_worker = {}
+
+
+def start_normalization_worker(normalizer):
+    if normalizer == "stem":
+        normalization_worker["normalize"] = nltk.PorterStemmer().stem
+        normalization_worker["skip_errors"] = True
+    else:
+        normalization_worker["normalize"] = nltk.stem.WordNetLemmatizer().lemmatize
+        normalization_worker["skip_errors"] = False
+
+
+# Normalize the words a chunk missed in the cache.  Returns the chunk index
+# and a (word, normalized word) pair for each.
+def normalize_words(indexed_words):
+    chunk_index, words_to_normalize = indexed_words
+    normalize = normalization_worker["normalize"]
+    skip_errors = normalization_worker["skip_errors"]
+    return chunk_index, [(word, normalize_word(normalize, word, skip_errors)) for word in words_to_normalize]
+
+
+
+################################################################################
+#
+# Load and save the normalization cache so it persists between runs, and
+# report how often it saved us from normalizing a word.
+#
+# A pool worker stems and lemmatizes with its own copy of the cache, so jobs
+# that normalize words in a pool go through run_with_normalization_cache.  It
+# drops whatever the worker's copy inherited from the parent, runs the job
+# and returns the new cache entries and hit and miss counts along with the
+# result.  merge_normalization_cache_updates adds them to the parent's cache
+# as the results come in, so the saved cache and its statistics cover the
+# work done in every process.
 #
 ################################################################################
 
-def lemmatize_words_array(words_array):
-    lemmatizer = nltk.stem.WordNetLemmatizer()
-    lemmatized_words_array = [];
-    for word in words_array:
-        lemma = lemmatizer.lemmatize(word)
-        lemmatized_words_array.append(lemma)
+def run_with_normalization_cache(job):
+    function, argument = job
+    normalization_cache.take_updates()
+    return function(argument), normalization_cache.take_updates()
+
+
+def merge_normalization_cache_updates(results):
+    for result, cache_updates in results:
+        normalization_cache.merge_updates(cache_updates)
+        yield result
 
-    return lemmatized_words_array;
+
+def load_normalization_cache(file_name):
+    normalization_cache.load(file_name)
+
+
+def save_normalization_cache(file_name):
+    normalization_cache.save(file_name)
+    log.log_json(dict(normalization_cache.stats(), cache=file_name))
 
 
 
@@ -457,7 +906,7 @@ def lemmatize_words_array(words_array):
 # for each corpus.
 #
 #################################################################################
-def compare_stemming_to_lemmatization():
+def compare_stemming_to_lemmatization(workers=1):
 
     # load each of the corpora
     abc_words = nltk.corpus.abc.words()
@@ -480,10 +929,10 @@ def compare_stemming_to_lemmatization():
     # in each
     for index, words in enumerate(all_words):
         logging.debug("Lemmatizing " + corpora_names[index])
-        lemmatized = collect_term_counts(lemmatize_words_array(words))
+        lemmatized = collect_term_counts(parallel_normalize_words_array(words, "lemma", workers))
         logging.debug("Stemming " + corpora_names[index])
-        stemmed = collect_term_counts(stem_words_array(words))
-        word_counts.extend([len(collect_term_counts(words))])
+        stemmed = collect_term_counts(parallel_normalize_words_array(words, "stem", workers))
+        word_counts.extend([len(vocabulary.Vocabulary(words))])
         lemmatized_counts.extend([len(lemmatized)])
         stemmed_counts.extend([len(stemmed)])
 
@@ -607,6 +1056,26 @@ def configure_command_line_arguments():
                                      required=False,
                                      action='store_true')
 
+    # Stem and lemmatize with this many processes
+    parser.add_argument('-w',
+                        '--workers',
+                        help="Number of processes used to stem or lemmatize.",
+                        required=False,
+                        type=int,
+                        default=1)
+
+    # Keep tokenized (and stemmed or lemmatized) corpora in a directory for later runs
+    parser.add_argument('-cc',
+                        '--corpusCache',
+                        help="Directory that stores tokenized corpora between runs.",
+                        required=False)
+
+    # Keep stems and lemmas in a file so later runs don't recompute them
+    parser.add_argument('-nc',
+                        '--normalizationCache',
+                        help="File that stores stems and lemmas between runs.",
+                        required=False)
+
     # What do you want to know?  These params allow one or more calculations to be run on
     # the input data.  In addition, you can ask the app to stem the data before running any
     # of these calculations